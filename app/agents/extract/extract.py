@@ -2,12 +2,12 @@
 # Extracts list from text
 #
 
-import json
 
-from app.llm import ChatModel
-from jinja2 import Environment, BaseLoader
+from app.agents.templates import get_template
+from app.llm import ChatModel, structured_output
+from app.metrics import measured
 
-GIVE_ME_LIST_PROMPT = open("app/agents/extract/list.prompt.jinja2", "r").read().strip()
+GIVE_ME_LIST_PROMPT = get_template("extract/list.prompt.jinja2")
 
 
 class GiveMeList:
@@ -18,37 +18,18 @@ class GiveMeList:
     def render(
             self, context: str
     ) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(GIVE_ME_LIST_PROMPT)
-        return template.render(
+        return GIVE_ME_LIST_PROMPT.render(
             context=context,
             language=self.language,
         )
 
-    def validate_response(self, response: str) -> list[str] | None:
-        response = response.strip().replace("```json", "```")
-
-        if response.startswith("```") and response.endswith("```"):
-            response = response[3:-3].strip()
-
-        try:
-            response = json.loads(response)
-        except Exception as _:
-            return None
-
-        if "list" not in response:
+    def validate_response(self, response: dict) -> list[str] | None:
+        if not isinstance(response.get("list"), list):
             return None
         else:
             return response["list"]
 
+    @measured("list")
     def execute(self, context: str) -> list[str]:
         prompt = self.render(context)
-        response = self.chat_model.inference(prompt)
-
-        valid_response: list[str] | None = self.validate_response(response)
-
-        while valid_response is None:
-            print("Invalid response from the model, trying again...")
-            return self.execute(context)
-
-        return valid_response
+        return structured_output.infer(self.chat_model, prompt, self.validate_response)
@@ -1 +1 @@
-from .investigate import Research, ResearchResponse, Investigation
\ No newline at end of file
+from .investigate import Research, ResearchResponse, FusedResearch, FusedResearchResponse, Investigation
\ No newline at end of file
@@ -1,13 +1,15 @@
-import json
 from dataclasses import dataclass
-from typing import Optional
 
-from app.llm import ChatModel
+from app.agents.templates import get_template
+from app.llm import ChatModel, structured_output
 from app.logger import Logger
-from jinja2 import Environment, BaseLoader
+from app.metrics import measured
 
-RESEARCH_PROMPT = open("app/agents/investigate/research.prompt.jinja2", "r").read().strip()
-INVESTIGATION_PROMPT = open("app/agents/investigate/investigation.prompt.jinja2", "r").read().strip()
+RESEARCH_PROMPT = get_template("investigate/research.prompt.jinja2")
+INVESTIGATION_PROMPT = get_template("investigate/investigation.prompt.jinja2")
+FUSED_RESEARCH_PROMPT = get_template("investigate/fused_research.prompt.jinja2")
+
+RESEARCH_ACTIONS = ("next", "more")
 
 
 @dataclass(frozen=True)
@@ -23,83 +25,84 @@ class Research:
         self.language = language
 
     def render(self, goal: str, context: str, piece: str) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(RESEARCH_PROMPT)
-        return template.render(
+        return RESEARCH_PROMPT.render(
             goal=goal,
             context=context,
             piece=piece,
             language=self.language,
         )
 
-    def validate_response(self, response: str) -> ResearchResponse | None:
-        response = response.strip().replace("```json", "```")
-
-        if response.startswith("```") and response.endswith("```"):
-            response = response[3:-3].strip()
-
-        try:
-            response = json.loads(response)
-        except Exception as _:
-            return None
-
-        if "draft" not in response or "action" not in response:
+    def validate_response(self, response: dict) -> ResearchResponse | None:
+        if "draft" not in response or response.get("action") not in RESEARCH_ACTIONS:
             return None
         else:
             return ResearchResponse(response["draft"], response["action"])
 
+    @measured("research")
     def execute(self, goal: str, context: str, piece: str) -> ResearchResponse:
         prompt = self.render(goal, context, piece)
-        response = self.chat_model.inference(prompt)
+        return structured_output.infer(self.chat_model, prompt, self.validate_response)
 
-        valid_response: Optional[ResearchResponse] = self.validate_response(response)
 
-        while valid_response is None:
-            print("Invalid response from the model, trying again...")
-            return self.execute(goal, context, piece)
+@dataclass(frozen=True)
+class FusedResearchResponse:
+    # the drafts in the order of the goals
+    drafts: list[str]
+    action: str
 
-        return valid_response
 
+class FusedResearch:
+    """Research of a piece of text for several goals at once, the drafts are keyed by the numbers of the goals."""
 
-class Investigation:
     def __init__(self, chat_model: ChatModel, language: str):
         self.logger = Logger()
         self.chat_model = chat_model
         self.language = language
 
-    def render(self, goal: str, context: str) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(INVESTIGATION_PROMPT)
-        return template.render(
-            goal=goal,
+    def render(self, goals: list[str], context: str, piece: str) -> str:
+        return FUSED_RESEARCH_PROMPT.render(
+            goals=goals,
             context=context,
+            piece=piece,
             language=self.language,
         )
 
-    def validate_response(self, response: str) -> str | None:
-        response = response.strip().replace("```json", "```")
+    @staticmethod
+    def validate_response(response: dict, goals: int) -> FusedResearchResponse | None:
+        drafts = response.get("drafts")
+        if not isinstance(drafts, dict) or response.get("action") not in RESEARCH_ACTIONS:
+            return None
+        # a goal without notes in this piece may be left out
+        return FusedResearchResponse([str(drafts.get(str(number)) or "") for number in range(1, goals + 1)],
+                                     response["action"])
 
-        if response.startswith("```") and response.endswith("```"):
-            response = response[3:-3].strip()
+    @measured("research")
+    def execute(self, goals: list[str], context: str, piece: str) -> FusedResearchResponse:
+        prompt = self.render(goals, context, piece)
+        return structured_output.infer(self.chat_model, prompt,
+                                       lambda response: self.validate_response(response, len(goals)))
 
-        try:
-            response = json.loads(response)
-        except Exception as _:
-            return None
 
+class Investigation:
+    def __init__(self, chat_model: ChatModel, language: str):
+        self.logger = Logger()
+        self.chat_model = chat_model
+        self.language = language
+
+    def render(self, goal: str, context: str) -> str:
+        return INVESTIGATION_PROMPT.render(
+            goal=goal,
+            context=context,
+            language=self.language,
+        )
+
+    def validate_response(self, response: dict) -> str | None:
         if "result" not in response:
             return None
         else:
             return response["result"]
 
+    @measured("investigation")
     def execute(self, goal: str, context: str) -> str:
         prompt = self.render(goal, context)
-        response = self.chat_model.inference(prompt)
-
-        valid_response: Optional[str] = self.validate_response(response)
-
-        while valid_response is None:
-            print("Invalid response from the model, trying again...")
-            return self.execute(goal, context)
-
-        return valid_response
+        return structured_output.infer(self.chat_model, prompt, self.validate_response)
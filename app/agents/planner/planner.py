@@ -1,7 +1,8 @@
+from app.agents.templates import get_template
 from app.llm import ChatModel
-from jinja2 import Environment, BaseLoader
+from app.metrics import measured
 
-PROMPT = open("app/agents/planner/prompt.jinja2").read().strip()
+PROMPT = get_template("planner/prompt.jinja2")
 
 
 class Planner:
@@ -10,10 +11,8 @@ class Planner:
         self.language = language
 
     def render(self, prompt: str) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(PROMPT)
-        return template.render(prompt=prompt,
-                               language=self.language)
+        return PROMPT.render(prompt=prompt,
+                             language=self.language)
 
     def validate_response(self, response: str) -> bool:
         return True
@@ -67,6 +66,7 @@ class Planner:
 
         return result
 
+    @measured("planner")
     def execute(self, prompt: str) -> str:
         prompt = self.render(prompt)
         response = self.chat_model.inference(prompt)
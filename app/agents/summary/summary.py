@@ -1,8 +1,10 @@
+from app.agents.templates import get_template
 from app.llm import ChatModel
 from app.logger import Logger
-from jinja2 import Environment, BaseLoader
+from app.metrics import measured, metrics
 
-PROMPT = open("app/agents/summary/prompt.jinja2", "r").read().strip()
+PROMPT = get_template("summary/prompt.jinja2")
+COMPACT_PROMPT = get_template("summary/compact.prompt.jinja2")
 
 
 class Summary:
@@ -12,9 +14,7 @@ class Summary:
         self.language = language
 
     def render(self, summary: str, new_lines: str) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(PROMPT)
-        return template.render(
+        return PROMPT.render(
             summary=summary,
             new_lines=new_lines,
             language=self.language,
@@ -23,6 +23,7 @@ class Summary:
     def validate_response(self, response: str) -> str:
         return response
 
+    @measured("summary")
     def execute(self, summary: str, new_lines: str) -> str:
         prompt = self.render(summary, new_lines)
         response = self.chat_model.inference(prompt)
@@ -31,6 +32,15 @@ class Summary:
 
         while not valid_response:
             print("Invalid response from the model, trying again...")
+            metrics.record_rejected()
+            self.chat_model.forget(prompt)
             return self.execute(summary, new_lines)
 
         return valid_response
+
+    @measured("compact")
+    def compact(self, summary: str, max_tokens: int) -> str:
+        # a word is about 4/3 tokens
+        prompt = COMPACT_PROMPT.render(summary=summary, max_words=max_tokens * 3 // 4, language=self.language)
+        response = self.chat_model.inference(prompt)
+        return self.validate_response(response) or summary
@@ -0,0 +1,33 @@
+#
+# Registry of the prompt templates of all agents
+#
+
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+
+TEMPLATES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _create_environment() -> Environment:
+    # compiled templates can be kept on disk to speed up the start of the next process
+    bytecode_cache = None
+    cache_dir = os.getenv("BRAN_TEMPLATE_CACHE_DIR")
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    return Environment(loader=FileSystemLoader(TEMPLATES_DIR),
+                       bytecode_cache=bytecode_cache,
+                       auto_reload=False,
+                       cache_size=-1)
+
+
+environment = _create_environment()
+
+# all templates are compiled once, when the agents are imported
+TEMPLATES: dict[str, Template] = {name: environment.get_template(name)
+                                  for name in environment.list_templates(extensions=["jinja2"])}
+
+
+def get_template(name: str) -> Template:
+    return TEMPLATES[name]
@@ -1,14 +1,18 @@
-import json
+import re
 from dataclasses import dataclass
-from typing import Optional
+from typing import Iterator
 
-from app.llm import ChatModel
+from app.agents.templates import get_template
+from app.llm import ChatModel, structured_output
 from app.logger import Logger
-from jinja2 import Environment, BaseLoader
+from app.metrics import measured, metrics
 
-STRUCTURE_PROMPT = open("app/agents/writer/structure.prompt.jinja2", "r").read().strip()
-SECTION_PROMPT = open("app/agents/writer/section.prompt.jinja2", "r").read().strip()
-KNOWLEDGE_PROMPT = open("app/agents/writer/knowledge.prompt.jinja2", "r").read().strip()
+STRUCTURE_PROMPT = get_template("writer/structure.prompt.jinja2")
+SECTION_PROMPT = get_template("writer/section.prompt.jinja2")
+KNOWLEDGE_PROMPT = get_template("writer/knowledge.prompt.jinja2")
+
+# whitespace and backticks at the end of the streamed text, they may be a part of the closing fence
+TRAILING_FENCE = re.compile(r"[`\s]*$")
 
 
 @dataclass(frozen=True)
@@ -24,42 +28,23 @@ class Structure:
         self.language = language
 
     def render(self, objective: str, plan: str, step: str) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(STRUCTURE_PROMPT)
-        return template.render(
+        return STRUCTURE_PROMPT.render(
             objective=objective,
             plan=plan,
             step=step,
             language=self.language,
         )
 
-    def validate_response(self, response: str) -> StructureResponse | None:
-        response = response.strip().replace("```json", "```")
-
-        if response.startswith("```") and response.endswith("```"):
-            response = response[3:-3].strip()
-
-        try:
-            response = json.loads(response)
-        except Exception as _:
-            return None
-
-        if "title" not in response or "sections" not in response:
+    def validate_response(self, response: dict) -> StructureResponse | None:
+        if "title" not in response or not isinstance(response.get("sections"), list):
             return None
         else:
             return StructureResponse(response["title"], response["sections"])
 
+    @measured("structure")
     def execute(self, objective: str, plan: str, step: str) -> StructureResponse:
         prompt = self.render(objective, plan, step)
-        response = self.chat_model.inference(prompt)
-
-        valid_response: Optional[StructureResponse] = self.validate_response(response)
-
-        while valid_response is None:
-            print("Invalid response from the model, trying again...")
-            return self.execute(objective, plan, step)
-
-        return valid_response
+        return structured_output.infer(self.chat_model, prompt, self.validate_response)
 
 
 @dataclass(frozen=True)
@@ -79,9 +64,7 @@ class WriterKnowledge:
                step: str,
                knowledge_keys: list[str],
                section: str) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(KNOWLEDGE_PROMPT)
-        return template.render(
+        return KNOWLEDGE_PROMPT.render(
             objective=objective,
             plan=plan,
             step=step,
@@ -90,37 +73,66 @@ class WriterKnowledge:
             language=self.language,
         )
 
-    def validate_response(self, response: str) -> WriterKnowledgeResponse | None:
-        response = response.strip().replace("```json", "```")
-
-        if response.startswith("```") and response.endswith("```"):
-            response = response[3:-3].strip()
-
-        try:
-            response = json.loads(response)
-        except Exception as _:
-            return None
-
-        if "need_more_data" not in response:
+    def validate_response(self, response: dict) -> WriterKnowledgeResponse | None:
+        if not isinstance(response.get("need_more_data"), list):
             return None
         else:
             return WriterKnowledgeResponse(response["need_more_data"])
 
+    @measured("knowledge")
     def execute(self, objective: str, plan: str, step: str, knowledge: dict[str, str],
                 section: str) -> WriterKnowledgeResponse:
-        def initial_step():
-            return self.chat_model.inference(self.render(objective, plan, step, list(knowledge.keys()), section))
-
-        def validate_step(response):
-            return self.validate_response(response)
-
-        while True:
-            response = initial_step()
-            valid_response = validate_step(response)
-
-            if valid_response is None:
-                print("Invalid response from the model, trying initial step again...")
-            return valid_response
+        prompt = self.render(objective, plan, step, list(knowledge.keys()), section)
+        valid_response = structured_output.infer(self.chat_model, prompt, self.validate_response)
+        # the model can make up keys which are not in the knowledge base
+        return WriterKnowledgeResponse([key for key in valid_response.need_more_data if key in knowledge])
+
+
+class FenceStripper:
+    """
+    Strips the ```md fence around a Markdown response while it is streamed, as `SectionWriter.validate_response`
+    does with the whole response. Only the trailing whitespace and backticks are held back until the end.
+    """
+
+    def __init__(self):
+        self._head = ""
+        self._started = False
+        self._fenced = False
+        self._leading = True
+        self._tail = ""
+
+    def _start(self, head: str) -> str:
+        self._started = True
+        head = head.lstrip()
+        if head.startswith("```"):
+            self._fenced = True
+            head = head[5:] if head.startswith("```md") else head[3:]
+        return head
+
+    def feed(self, text: str) -> str:
+        if not self._started:
+            self._head += text
+            # wait for enough text to see the opening fence
+            if len(self._head.lstrip()) < 5:
+                return ""
+            text = self._start(self._head)
+        if self._leading:
+            text = text.lstrip()
+            self._leading = not text
+
+        self._tail += text
+        held = len(TRAILING_FENCE.search(self._tail).group())
+        text, self._tail = self._tail[:len(self._tail) - held], self._tail[len(self._tail) - held:]
+        return text
+
+    def close(self) -> str:
+        text = ""
+        if not self._started:
+            text = self._start(self._head).lstrip()
+        tail = (text + self._tail).rstrip()
+        if self._fenced and tail.endswith("```"):
+            tail = tail[:-3].rstrip()
+        return tail
 
 
 class SectionWriter:
@@ -135,9 +147,7 @@ class SectionWriter:
                step: str,
                knowledge: list[str],
                section: str) -> str:
-        env = Environment(loader=BaseLoader())
-        template = env.from_string(SECTION_PROMPT)
-        return template.render(
+        return SECTION_PROMPT.render(
             objective=objective,
             plan=plan,
             step=step,
@@ -154,6 +164,7 @@ class SectionWriter:
 
         return response
 
+    @measured("section")
     def execute(self,
                 objective: str,
                 plan: str,
@@ -173,3 +184,20 @@ class SectionWriter:
             if not initial_response:
                 print("Invalid response from the model, trying again...")
             return initial_response
+
+    def stream(self,
+               objective: str,
+               plan: str,
+               step: str,
+               knowledge: list[str],
+               section: str) -> Iterator[str]:
+        """Yields the content of the section as soon as it is generated."""
+        with metrics.agent("section"):
+            stripper = FenceStripper()
+            for part in self.chat_model.stream(self.render(objective, plan, step, knowledge, section)):
+                text = stripper.feed(part)
+                if text:
+                    yield text
+            text = stripper.close()
+            if text:
+                yield text
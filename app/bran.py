@@ -1,106 +1,607 @@
 import json
 import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Sequence, TypeVar
 
 from app.agents.action import Action
 from app.agents.action.action import ActionResponse
 from app.agents.extract import GiveMeList
-from app.agents.investigate import Research, Investigation, ResearchResponse
+from app.agents.investigate import FusedResearch, FusedResearchResponse, Research, Investigation, ResearchResponse
 from app.agents.planner import Planner
 from app.agents.summary import Summary
 from app.agents.writer import Structure
 from app.agents.writer.writer import SectionWriter, WriterKnowledge, WriterKnowledgeResponse
-from app.llm import ChatModel
+from app.corpus import BM25Index, ChunkIndex, ChunkStream, HashingEmbedder, OpenAIEmbedder, VectorStore, \
+    chunk_files, has_item, resolve_sources, with_neighbors
+from app.corpus.vectors import Embedder, normalize
+from app.llm import ChatModel, ModelRouter, ResponseCache, TieredModel, count_tokens, get_encoding, structured_output
+from app.llm.batch import BatchError, BatchJob, LocalBatchBackend, OpenAIBatchBackend
+from app.checkpoint import RunState, default_run_dir
+from app.digest import DocumentDigest
+from app.document import StreamingDocument
+from app.drafts import DraftCache
+from app.knowledge import KnowledgeStore
 from app.logger import Logger
+from app.metrics import metrics
+from app.scheduler import PlanItem, PlanScheduler, WRITING_ACTIONS, link_plan_items
+import numpy as np
 from phoenix.trace.openai import OpenAIInstrumentor
-from spacy.lang.en import English
-from spacy.lang.ru import Russian
 
 Logger.dateFmt = "---\\n%y.%m.%d %H:%M:%S"
 logger = Logger()
 
-# Initialize OpenAI auto-instrumentation
-OpenAIInstrumentor().instrument()
+_instrumented = False
+
+
+def instrument():
+    """
+    Initializes the OpenAI auto-instrumentation once per process, when a Bran is created rather than on import:
+    the spawned workers which split the documentation import the main module too.
+    """
+    global _instrumented
+    if not _instrumented:
+        OpenAIInstrumentor().instrument()
+        _instrumented = True
+
+
+T = TypeVar("T")
+
+INVESTIGATION_MODES = ('sequential', 'map-reduce', 'fused')
+RETRIEVAL_MODES = ('none', 'bm25', 'dense')
+CONTEXT_MODES = ('running', 'digest')
+# EMBEDDING_MODEL_ID of the offline hashing embedder
+HASHING_EMBEDDER = 'hashing'
 
 
 class Bran:
-    def __init__(self, language: str = 'Russian'):
+    # how many summaries are merged into one on each level of the digest of the documentation
+    digest_fan_in = 8
+    # how many results of the investigations are given to a section writer with the dense retrieval
+    knowledge_top_k = 3
+    # share of the research prompt budget taken by the summary of the text that has been read
+    summary_share = 0.3
+
+    def __init__(self, language: str = 'Russian', use_cache: bool = True, investigation_mode: str = 'sequential',
+                 plan_workers: int = 4, retrieval: str = 'none', top_k: int = 20, neighbors: int = 1,
+                 batch: bool = False, stream: bool = False, context: str = 'running'):
+        if investigation_mode not in INVESTIGATION_MODES:
+            raise ValueError(f'Unsupported investigation mode: {investigation_mode}')
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f'Unsupported retrieval mode: {retrieval}')
+        if retrieval == 'dense' and not os.getenv("EMBEDDING_MODEL_ID"):
+            raise ValueError("The dense retrieval needs an embedding model: set EMBEDDING_MODEL_ID, "
+                             f"or EMBEDDING_MODEL_ID={HASHING_EMBEDDER} for the offline embedder meant for testing")
+        if context not in CONTEXT_MODES:
+            raise ValueError(f'Unsupported context mode: {context}')
+        instrument()
         self.language = language
+        self.investigation_mode = investigation_mode
+        # what the sequential research is given as the text read before a piece: a running summary of every goal
+        # or the digest of the documentation shared by all goals
+        self.context_mode = context
+        self.plan_workers = plan_workers
+        # whether independent prompts are sent with the Batch API
+        self.batch = batch
+        # whether the sections are written into the document as the model generates them
+        self.stream = stream
+        # which pieces of the documentation are researched for a goal: all of them or the most relevant ones
+        self.retrieval = retrieval
+        self.top_k = top_k
+        self.neighbors = neighbors
+        # token budgets of the prompts
+        self.context_window = int(os.getenv("CHAT_MODEL_CONTEXT_TOKENS", "16384"))
+        self.response_tokens = int(os.getenv("CHAT_MODEL_RESPONSE_TOKENS", "2048"))
         self.chat_model = ChatModel(model_id=os.environ["CHAT_MODEL_ID"],
-                                    is_azure=os.getenv("CHAT_MODEL_AZURE", 'False').lower() in ('true', '1', 't'))
-        self.give_me_list = GiveMeList(self.chat_model, language=self.language)
-        self.structure_writer = Structure(self.chat_model, language=self.language)
-        self.section_writer = SectionWriter(self.chat_model, language=self.language)
-        self.writer_knowledge = WriterKnowledge(self.chat_model, language=self.language)
-        self.planner = Planner(self.chat_model, language=self.language)
-        self.action = Action(self.chat_model)
-        self.research = Research(self.chat_model, language=self.language)
-        self.summarizer = Summary(self.chat_model, language=self.language)
-        self.investigation = Investigation(self.chat_model, language=self.language)
+                                    is_azure=os.getenv("CHAT_MODEL_AZURE", 'False').lower() in ('true', '1', 't'),
+                                    cache=ResponseCache.from_env(enabled=use_cache))
+        # every agent may have its own model, `chat_model` is the default one
+        self.models = ModelRouter(self.chat_model)
+        self.give_me_list = GiveMeList(self.models.route("list"), language=self.language)
+        self.structure_writer = Structure(self.models.route("structure"), language=self.language)
+        self.section_writer = SectionWriter(self.models.route("section"), language=self.language)
+        self.writer_knowledge = WriterKnowledge(self.models.route("knowledge"), language=self.language)
+        self.planner = Planner(self.models.route("planner"), language=self.language)
+        self.action = Action(self.models.route("action"))
+        self.research = Research(self.models.route("research"), language=self.language)
+        self.fused_research = FusedResearch(self.models.route("research"), language=self.language)
+        self.summarizer = Summary(self.models.route("summary"), language=self.language)
+        self.investigation = Investigation(self.models.route("investigation"), language=self.language)
+        if self.models.is_routed():
+            logger.info(f"Models of the agents:\n{self.models.describe()}")
+        # research drafts of the unchanged pieces are reused when the documentation is edited
+        self.drafts = DraftCache(ResponseCache(directory=os.getenv("DRAFT_CACHE_DIR", ".bran_cache/drafts"),
+                                               enabled=self.chat_model.cache.enabled),
+                                 model_id=self.research.chat_model.model_id)
+        self._documentation_lock = threading.Lock()
         self.documentation = list()
-        self.knowledge = dict()
-
-    def _create_nlp_object(self):
-        if self.language == 'Russian':
-            return Russian()
-        elif self.language == 'English':
-            return English()
-        # add more languages as needed
-        else:
-            raise ValueError(f'Unsupported language: {self.language}')
+        self._lexical_index: Optional[BM25Index] = None
+        self._vector_store: Optional[VectorStore] = None
+        self._knowledge_vectors: dict[str, np.ndarray] = dict()
+        self._digest: Optional[DocumentDigest] = None
+        self._digest_lock = threading.Lock()
+        # the goals of the investigations which read the documentation together in the fused mode, and their notes
+        self.fused_goals: list[str] = []
+        self._fused_notes: Optional[dict[str, list[str]]] = None
+        self._fused_lock = threading.Lock()
+        self.run = RunState()
+        # the results of the investigations, split into fragments for the sections of the documents
+        self.knowledge = KnowledgeStore(count_tokens=self.count_tokens,
+                                        fragment_tokens=int(os.getenv("KNOWLEDGE_FRAGMENT_TOKENS", "256")))
+        self.knowledge_tokens = int(os.getenv("SECTION_KNOWLEDGE_TOKENS", "4096"))
+
+    def chunking_params(self) -> dict:
+        return {"language": self.language,
+                "encoding": get_encoding(self.chat_model.model_id).name,
+                "max_tokens": int(os.getenv("CHUNK_TOKENS", "1024")),
+                "overlap": int(os.getenv("CHUNK_OVERLAP_TOKENS", "0"))}
 
     @property
-    def documentation(self) -> list[str]:
-        if len(self._documentation) == 0:
-            # load text file from data_path
-            data_path = os.environ["DATA_PATH"]
-            logger.info(f"Loading data from {data_path}")
-            with open(data_path, "r", encoding="utf-8") as f:
-                text = f.read()
-
-            # split into sentences
-            nlp_simple = self._create_nlp_object()
-            nlp_simple.add_pipe('sentencizer')
-            doc = nlp_simple(text)
-            sentences = [str(sent).strip() for sent in doc.sents]
-
-            # make groups of sentences
-            group_size = 20
-            self._documentation = ["\\n".join(sentences[i: i + group_size]) for i in
-                                   range(0, len(sentences), group_size)]
+    def documentation(self) -> Sequence[str]:
+        """
+        The pieces of the documentation. When the documentation is split for the first time, the pieces are
+        a stream which grows while the files are parsed in the background, and the index replaces it when it is built.
+        """
+        with self._documentation_lock:
+            # a stream which is being split is not empty, its length is not known yet
+            if not isinstance(self._documentation, ChunkStream) and len(self._documentation) == 0:
+                # load text files from data_path: a file, a directory or a glob pattern
+                data_path = os.environ["DATA_PATH"]
+                sources = resolve_sources(data_path)
+                logger.info(f"Loading data from {data_path} ({len(sources)} files)")
+                params = self.chunking_params()
+                directory, meta = ChunkIndex.locate(cache_dir=os.getenv("CORPUS_CACHE_DIR", ".bran_cache/corpus"),
+                                                    name=data_path,
+                                                    source_paths=sources,
+                                                    params=params)
+                if ChunkIndex.exists(directory):
+                    self._documentation = ChunkIndex(directory)
+                    logger.info(f"The documentation is split into {len(self._documentation)} pieces "
+                                f"(loaded from the index)")
+                else:
+                    stream = ChunkStream()
+                    self._documentation = stream
+                    threading.Thread(target=self._build_documentation,
+                                     args=(stream, directory, meta, sources, params),
+                                     name="documentation-index").start()
         return self._documentation
 
+    def _build_documentation(self, stream: ChunkStream, directory: str, meta: dict, sources: list[str],
+                             params: dict):
+        chunks = chunk_files(sources, params, workers=int(os.getenv("CORPUS_WORKERS", "0")))
+        try:
+            index = ChunkIndex.build(directory, stream.tee(chunks), meta, written=stream.written)
+        except BaseException as e:
+            stream.complete(e)
+            raise
+        # the new readers get the index before the stream is complete, the readers of the stream switch to it
+        with self._documentation_lock:
+            self._documentation = index
+        stream.complete(index=index)
+        logger.info(f"The documentation is split into {len(index)} pieces")
+
+    def indexed_documentation(self) -> Sequence[str]:
+        """Returns all pieces of the documentation, waiting until it is split."""
+        documentation = self.documentation
+        if isinstance(documentation, ChunkStream):
+            documentation.wait()
+            return self.documentation
+        return documentation
+
+    def cite(self, index: int) -> str:
+        documentation = self.indexed_documentation()
+        if not isinstance(documentation, ChunkIndex):
+            return f"piece {index + 1}"
+        source, offset = documentation.source(index)
+        return f"{os.path.relpath(source)}:{offset}"
+
     @documentation.setter
-    def documentation(self, value: list[str]):
+    def documentation(self, value: Sequence[str]):
         self._documentation = value
 
     def prepare_plan(self, objective: str) -> (str, list[str]):
+        if self.run.plan is not None:
+            logger.info("I'm resuming the plan of the previous run")
+            return self.run.plan, self.run.plan_items
         plan = self.planner.execute(objective)
         plan_items: list[str] = self.give_me_list.execute(plan)
+        self.run.save_plan(plan, plan_items)
         return plan, plan_items
 
     def what_should_i_do(self, plan: str, goal: str) -> ActionResponse:
         return self.action.execute(plan, goal)
 
-    def investigate(self, goal):
+    @property
+    def lexical_index(self) -> BM25Index:
+        documentation = self.indexed_documentation()
+        with self._documentation_lock:
+            if self._lexical_index is None:
+                self._lexical_index = BM25Index(documentation)
+        return self._lexical_index
+
+    def _create_embedder(self) -> Embedder:
+        model_id = os.getenv("EMBEDDING_MODEL_ID")
+        if model_id == HASHING_EMBEDDER:
+            logger.warning("The pieces are selected by the hashing embedder, which compares the words of the texts "
+                           "rather than their meaning")
+            return HashingEmbedder()
+        return OpenAIEmbedder(model_id=model_id,
+                              is_azure=os.getenv("CHAT_MODEL_AZURE", 'False').lower() in ('true', '1', 't'))
+
+    @property
+    def vector_store(self) -> VectorStore:
+        documentation = self.indexed_documentation()
+        with self._documentation_lock:
+            if self._vector_store is None:
+                embedder = self._create_embedder()
+                if isinstance(documentation, ChunkIndex):
+                    self._vector_store, reused = VectorStore.open_or_build(documentation.directory, documentation,
+                                                                           embedder)
+                    logger.info(f"Embeddings of the documentation are {'loaded' if reused else 'computed'}")
+                else:
+                    self._vector_store = VectorStore.build(documentation, embedder)
+        return self._vector_store
+
+    def select_pieces(self, goal: str) -> tuple[Optional[list[int]], Sequence[str]]:
+        """Returns the positions of the selected pieces in the documentation, None for all of them, and the pieces."""
+        if self.retrieval == 'none':
+            return None, self.documentation
+        documentation = self.indexed_documentation()
+        if self.retrieval == 'dense':
+            found = self.vector_store.search(goal, k=self.top_k)
+            selected = with_neighbors([index for index, _ in found], self.neighbors, len(documentation))
+            similarities = ', '.join(f'{similarity:.2f}' for _, similarity in found[:5])
+            logger.info(f"I've selected {len(selected)} of {len(documentation)} pieces for `{goal}`, "
+                        f"the best similarities are {similarities}")
+            self.log_citations(goal, [index for index, _ in found[:5]])
+            return selected, [documentation[index] for index in selected]
+
+        selected, scores = self.lexical_index.top_k(goal, k=self.top_k, neighbors=self.neighbors)
+        total_score = float(scores.sum())
+        covered_score = float(scores[selected].sum()) if selected else 0.0
+        matching = int((scores > 0).sum())
+        left_out = matching - int((scores[selected] > 0).sum()) if selected else matching
+        logger.info(f"I've selected {len(selected)} of {len(documentation)} pieces for `{goal}`: "
+                    f"they cover {covered_score / total_score if total_score else 0:.0%} of the relevance score, "
+                    f"{left_out} matching pieces are left out")
+        self.log_citations(goal, sorted(selected, key=lambda index: -scores[index])[:5])
+        return selected, [documentation[index] for index in selected]
+
+    def log_citations(self, goal: str, indices: list[int]):
+        logger.debug(lambda: f"The best pieces for `{goal}` are at {', '.join(self.cite(index) for index in indices)}")
+
+    @property
+    def digest(self) -> DocumentDigest:
+        """The digest of the documentation, built by the first investigation which needs it."""
+        with self._digest_lock:
+            if self._digest is None:
+                documentation = self.indexed_documentation()
+                with ThreadPoolExecutor(max_workers=self.chat_model.max_in_flight) as pool, \
+                        metrics.plan_item("documentation digest"):
+                    def mapper(fn, items):
+                        return pool.map(metrics.bind(fn), items)
+
+                    if isinstance(documentation, ChunkIndex):
+                        self._digest, reused = DocumentDigest.open_or_build(
+                            documentation.directory, f"{self.summarizer.chat_model.model_id}-{self.language}",
+                            documentation,
+                            self.summarizer.execute, self.digest_fan_in, mapper)
+                    else:
+                        self._digest, reused = DocumentDigest.build(
+                            documentation, self.summarizer.execute, self.digest_fan_in, mapper), False
+                logger.info(f"The digest of {len(self._digest)} pieces of the documentation is "
+                            f"{'loaded' if reused else 'built'}, it has {len(self._digest.levels)} levels")
+        return self._digest
+
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self.chat_model.model_id)
+
+    def prompt_budget(self, empty_prompt: str) -> int:
+        """Returns how many tokens can be added to `empty_prompt` within the context window of the model."""
+        return self.context_window - self.response_tokens - self.count_tokens(empty_prompt)
+
+    def truncate(self, text: str, budget: int) -> str:
+        encoding = get_encoding(self.chat_model.model_id)
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= budget else encoding.decode(tokens[:max(0, budget)])
+
+    def research_budget(self, empty_prompt: str) -> tuple[int, int]:
+        """
+        Returns how many tokens of the research prompt can be taken by the summary and by the piece of text,
+        `empty_prompt` is the prompt without them.
+        """
+        available = self.prompt_budget(empty_prompt)
+        summary_budget = int(available * self.summary_share)
+        return summary_budget, available - summary_budget
+
+    def compact_context(self, context: str, budget: int) -> str:
+        tokens = self.count_tokens(context)
+        if tokens <= budget:
+            return context
+        compacted = self.summarizer.compact(context, max_tokens=budget // 2)
+        logger.info(f"The summary has grown to {tokens} tokens over the budget of {budget}, "
+                    f"I've compacted it to {self.count_tokens(compacted)} tokens")
+        return compacted
+
+    def research_sequentially(self, goal: str, pieces: Sequence[str],
+                              positions: Optional[list[int]] = None) -> list[str]:
+        def research(context: str, piece: str) -> tuple[str, str]:
+            outcome: ResearchResponse = self.research.execute(goal, context, piece)
+            return outcome.draft, outcome.action
+
+        return self.read_sequentially('sequential', goal, f"`{goal}`", self.research.render(goal, "", ""), research,
+                                      pieces, positions)
+
+    def research_fused(self, goals: list[str], pieces: Sequence[str],
+                       positions: Optional[list[int]] = None) -> list[list[str]]:
+        """Researches the pieces in order for all goals at once, returns the notes of every goal."""
+        def research(context: str, piece: str) -> tuple[str, str]:
+            outcome: FusedResearchResponse = self.fused_research.execute(goals, context, piece)
+            return json.dumps(outcome.drafts, ensure_ascii=False), outcome.action
+
+        drafts = self.read_sequentially('fused', "\n".join(goals), f"{len(goals)} goals",
+                                        self.fused_research.render(goals, "", ""), research, pieces, positions)
+        drafts_of_pieces = [json.loads(draft) for draft in drafts]
+        return [[piece_drafts[number] for piece_drafts in drafts_of_pieces] for number in range(len(goals))]
+
+    def read_sequentially(self, kind: str, key: str, label: str, empty_prompt: str,
+                          research: Callable[[str, str], tuple[str, str]], pieces: Sequence[str],
+                          positions: Optional[list[int]] = None) -> list[str]:
+        """
+        Researches the pieces in order with `research(context, piece) -> (draft, action)` and returns the drafts.
+        The research of a piece is given the summary of the text before it: the running summary of the pieces read
+        so far, or the context of the piece in the digest of the documentation, then `positions` are the positions
+        of the pieces in the documentation. `key` identifies the research in the saved progress and the draft cache,
+        `label` names it in the log.
+        """
+        summary_budget, piece_budget = self.research_budget(empty_prompt)
+        use_digest = self.context_mode == 'digest'
+        digest = self.digest if use_digest else None
+        mode = f"{kind}-digest" if use_digest else kind
         context: str = ""
         notes: list[str] = []
-        sentences_iterator = iter(self.documentation)
-        for sentence in sentences_iterator:
-            piece = sentence
+        index = 0
+        state = self.drafts.initial_state(mode, key, self.language, summary_budget, piece_budget)
+        # follow the chain of the drafts saved by the previous run
+        drafts = self.run.drafts(key, mode)
+        while index in drafts:
+            notes.append(drafts[index]["draft"])
+            context = drafts[index]["context"]
+            state = drafts[index]["state"]
+            index = drafts[index]["next"]
+        if notes:
+            logger.info(f"I'm resuming the research of {label} from piece {index + 1}")
+
+        reused = 0
+        first_changed: Optional[int] = None
+        while has_item(pieces, index):
+            start = index
+            cached = self.drafts.get(state, pieces, index)
+            if cached is not None:
+                # the piece and the summary of all previous pieces are the same as before
+                index += len(cached["digests"])
+                context = cached["context"]
+                notes.append(cached["draft"])
+                state = self.drafts.advance(state, pieces[start:index])
+                self.run.save_draft(key, mode, start, cached["draft"], context=context, next=index, state=state)
+                reused += 1
+                continue
+
+            if first_changed is None:
+                first_changed = start
+            if use_digest:
+                context = self.compact_context(digest.context(positions[start] if positions else start),
+                                               summary_budget)
+            piece = pieces[index]
+            piece_tokens = self.count_tokens(piece)
+            index += 1
             while True:
-                outcome: ResearchResponse = self.research.execute(goal, context, piece)
-                if outcome.action == "more":
-                    try:
-                        piece = piece + "\n" + next(sentences_iterator)
-                    except StopIteration:
-                        pass
-                else:
+                draft, action = research(context, piece)
+                if action != "more" or not has_item(pieces, index):
+                    break
+                next_tokens = self.count_tokens(pieces[index])
+                if piece_tokens + next_tokens + 1 > piece_budget:
+                    logger.info(f"The piece of text can't grow over {piece_budget} tokens, I'll go on with the next one")
                     break
-            context = self.summarizer.execute(context, piece)
-            notes.append(outcome.draft)
+                piece = piece + "\n" + pieces[index]
+                piece_tokens += next_tokens + 1
+                index += 1
+            if not use_digest:
+                context = self.compact_context(self.summarizer.execute(context, piece), summary_budget)
+            notes.append(draft)
+            self.drafts.put(state, pieces[start:index], draft, context)
+            state = self.drafts.advance(state, pieces[start:index])
+            self.run.save_draft(key, mode, start, draft, context=context, next=index, state=state)
+
+        if reused:
+            changed = f"from piece {first_changed + 1}" if first_changed is not None else "nothing"
+            logger.info(f"I've reused {reused} research drafts of unchanged pieces for {label}, "
+                        f"I've read again {changed}")
+        return notes
+
+    def new_batch_job(self, chat_model: ChatModel) -> BatchJob:
+        directory = os.getenv("BATCH_DIR", ".bran_cache/batches")
+        if os.getenv("BATCH_BACKEND", "openai") == "local":
+            backend = LocalBatchBackend(directory, responder=lambda body: chat_model.inference(
+                body["messages"][-1]["content"], json_mode="response_format" in body))
+        else:
+            backend = OpenAIBatchBackend(is_azure=chat_model.is_azure)
+        return BatchJob(chat_model, backend, directory,
+                        poll_interval=float(os.getenv("BATCH_POLL_SECONDS", "30")),
+                        max_wait=float(os.getenv("BATCH_MAX_WAIT_HOURS", "24")) * 3600)
+
+    def infer_in_batch(self, chat_model: ChatModel | TieredModel, prompts: list[str],
+                       validate: Callable[[dict], Optional[T]]) -> list[Optional[T]]:
+        """
+        Sends the prompts in one batch and returns the validated responses in the same order.
+        Responses which are missing or invalid are None, they should be requested online.
+        The batch goes to the first model of a tiered one, the online requests escalate as usual.
+        """
+        chat_model = chat_model.tiers[0]
+        job = self.new_batch_job(chat_model)
+        for index, prompt in enumerate(prompts):
+            job.add(str(index), prompt, json_mode=True)
+        logger.info(f"I've submitted a batch of {len(prompts)} requests, waiting for the responses...")
+        try:
+            responses = job.run()
+        except BatchError as e:
+            logger.warning(f"{e}, I will send the requests online")
+            responses = {}
+
+        results = []
+        for index, prompt in enumerate(prompts):
+            response = responses.get(str(index))
+            result = structured_output.parse(response, validate) if response is not None else None
+            if result is None:
+                chat_model.forget(prompt, json_mode=True)
+            results.append(result)
+        logger.info(f"I've received {sum(result is not None for result in results)} valid responses of "
+                    f"{len(prompts)} from the batch")
+        return results
+
+    def research_in_parallel(self, goal: str, pieces: Sequence[str]) -> list[str]:
+        """
+        Researches every piece independently. The pieces are submitted as soon as they are available,
+        so the research starts while the documentation is still being split.
+        """
+        _, piece_budget = self.research_budget(self.research.render(goal, "", ""))
+        state = self.drafts.initial_state('map-reduce', goal, self.language, piece_budget)
+        drafts = self.run.drafts(goal, 'map-reduce')
+        if drafts:
+            logger.info(f"I've already researched {len(drafts)} pieces for `{goal}`")
+
+        cached: dict[int, dict] = {}
+        outcomes: dict[int, Optional[ResearchResponse]] = {}
+        if self.batch:
+            # a batch is sent at once, so all pieces and their cached drafts are needed up front
+            for index in range(len(pieces)):
+                if index not in drafts and (record := self.drafts.get(state, pieces, index)) is not None:
+                    cached[index] = record
+            missing = [index for index in range(len(pieces)) if index not in drafts and index not in cached]
+            if missing:
+                responses = self.infer_in_batch(self.research.chat_model,
+                                                [self.research.render(goal, "", pieces[index]) for index in missing],
+                                                self.research.validate_response)
+                outcomes = dict(zip(missing, responses))
+        reused: list[int] = []
+
+        def research_piece(index: int) -> str:
+            if index in drafts:
+                return drafts[index]["draft"]
+            record = cached.get(index) if self.batch else self.drafts.get(state, pieces, index)
+            if record is not None:
+                reused.append(index)
+                self.run.save_draft(goal, 'map-reduce', index, record["draft"])
+                return record["draft"]
+            piece = pieces[index]
+            end = index + 1
+            outcome: ResearchResponse = outcomes.get(index) or self.research.execute(goal, "", piece)
+            if outcome.action == "more" and has_item(pieces, index + 1):
+                longer_piece = piece + "\n" + pieces[index + 1]
+                # there is no summary of the previous text, so show the piece together with the next one
+                if self.count_tokens(longer_piece) <= piece_budget:
+                    outcome = self.research.execute(goal, "", longer_piece)
+                    end += 1
+            self.drafts.put(state, pieces[index:end], outcome.draft)
+            self.run.save_draft(goal, 'map-reduce', index, outcome.draft)
+            return outcome.draft
+
+        with ThreadPoolExecutor(max_workers=self.chat_model.max_in_flight) as pool:
+            # enumerating a stream yields the pieces as they are split
+            futures = [pool.submit(metrics.bind(research_piece), index) for index, _ in enumerate(pieces)]
+            notes = [future.result() for future in futures]
+        if reused:
+            logger.info(f"I've reused {len(reused)} research drafts of unchanged pieces for `{goal}`, "
+                        f"{len(notes) - len(reused) - len(drafts)} pieces are new or changed")
+        return notes
+
+    def reduce_notes(self, notes: list[str], budget: int) -> list[str]:
+        """
+        Merges the notes level by level until all of them fit `budget` tokens. The notes are merged in groups
+        which fit the prompt of the summary, a note too long for it on its own is cut.
+        """
+        def merge(group: list[str]) -> str:
+            if len(group) == 1:
+                return group[0]
+            return self.summarizer.execute(group[0], "\n".join(group[1:]))
+
+        def tokens(notes: list[str]) -> int:
+            return self.count_tokens("\n".join(notes))
+
+        merge_budget = self.prompt_budget(self.summarizer.render("", ""))
+        notes = [note for note in notes if note.strip()]
+        level = 0
+        with ThreadPoolExecutor(max_workers=self.chat_model.max_in_flight) as pool:
+            while len(notes) > 1 and tokens(notes) > budget:
+                level += 1
+                groups, group_tokens = [], 0
+                for note in notes:
+                    note = self.truncate(note, merge_budget)
+                    note_tokens = self.count_tokens(note) + 1
+                    if not groups or group_tokens + note_tokens > merge_budget:
+                        groups.append([])
+                        group_tokens = 0
+                    groups[-1].append(note)
+                    group_tokens += note_tokens
+                if len(groups) == len(notes):
+                    # no two notes fit one prompt of the summary, the notes are cut to share it
+                    share = merge_budget // 2 - 1
+                    groups = [[self.truncate(note, share) for note in notes[i: i + 2]]
+                              for i in range(0, len(notes), 2)]
+                logger.info(f"Merging {len(notes)} notes of {tokens(notes)} tokens over the budget of {budget} "
+                            f"into {len(groups)} (level {level})")
+                notes = list(pool.map(metrics.bind(merge), groups))
+        if tokens(notes) > budget:
+            notes = [self.truncate("\n".join(notes), budget)]
+        return notes
+
+    def fused_notes(self, goal: str) -> list[str]:
+        """
+        Returns the notes of the goal from the single pass over the documentation for all pending investigations,
+        the first investigation makes the pass and the others wait for it.
+        """
+        with self._fused_lock:
+            if self._fused_notes is None:
+                goals = self.fused_goals or [goal]
+                selections = [self.select_pieces(fused_goal) for fused_goal in goals]
+                if self.retrieval == 'none' or any(positions is None for positions, _ in selections):
+                    positions, pieces = None, self.documentation
+                else:
+                    # the pieces selected for any of the goals are read once in the document order
+                    documentation = self.indexed_documentation()
+                    positions = sorted(set().union(*(positions for positions, _ in selections)))
+                    pieces = [documentation[index] for index in positions]
+                logger.info(f"I'm researching the documentation for {len(goals)} goals at once")
+                with metrics.plan_item(f"fused research of {len(goals)} goals"):
+                    notes = self.research_fused(goals, pieces, positions)
+                self._fused_notes = dict(zip(goals, notes))
+            notes = self._fused_notes.get(goal)
+        if notes is None:
+            # the goal hasn't been known when the pass started
+            positions, pieces = self.select_pieces(goal)
+            notes = self.research_fused([goal], pieces, positions)[0]
+        return notes
+
+    def investigate(self, goal):
+        if self.investigation_mode == 'fused':
+            notes = self.fused_notes(goal)
+        else:
+            positions, pieces = self.select_pieces(goal)
+            if self.investigation_mode == 'map-reduce':
+                notes = self.research_in_parallel(goal, pieces)
+            else:
+                notes = self.research_sequentially(goal, pieces, positions)
+
+        if self.retrieval != 'none':
+            useful = sum(1 for note in notes if note.strip())
+            logger.info(f"{useful} of {len(notes)} selected pieces have given notes for `{goal}`")
+
+        # the notes of all modes are merged when they don't fit the prompt of the investigation
+        notes = self.reduce_notes(notes, self.prompt_budget(self.investigation.render(goal, "")))
 
         text_of_notes = '\n'.join(notes)
-        logger.debug(f"Notes: {text_of_notes}")
+        logger.debug(lambda: f"Notes: {text_of_notes}")
 
         investigation_result: str = self.investigation.execute(goal, text_of_notes)
         return investigation_result
@@ -110,13 +611,31 @@ class Bran:
                                              plan=plan,
                                              step=step)
 
+    def section_knowledge(self,
+                          objective: str,
+                          plan: str,
+                          step: str,
+                          required_knowledge: list[str],
+                          section: str) -> list[str]:
+        """
+        Returns the fragments of the required results which are the most relevant to the section. They fit
+        SECTION_KNOWLEDGE_TOKENS and what is left of the context window by the rest of the prompt.
+        """
+        available = self.context_window - self.response_tokens - self.count_tokens(
+            self.section_writer.render(objective, plan, step, [], section))
+        budget = max(0, min(self.knowledge_tokens, available))
+        knowledge = self.knowledge.select(f"{section}\n{step}", budget, goals=required_knowledge)
+        logger.info(f"The section `{section}` is given {len(knowledge)} fragments of the knowledge base "
+                    f"within {budget} tokens")
+        return knowledge
+
     def write_document_section(self,
                                objective: str,
                                plan: str,
                                step: str,
                                required_knowledge: list[str],
                                section: str) -> str:
-        knowledge = [self.knowledge[key] for key in required_knowledge]
+        knowledge = self.section_knowledge(objective, plan, step, required_knowledge, section)
         return self.section_writer.execute(objective=objective,
                                            plan=plan,
                                            step=step,
@@ -124,55 +643,205 @@ class Bran:
                                            knowledge=knowledge)
 
     def what_should_i_know(self, objective: str, plan: str, step: str, section: str) -> WriterKnowledgeResponse:
+        if self.retrieval == 'dense' and self.knowledge:
+            return self.pick_knowledge(step=step, section=section)
         return self.writer_knowledge.execute(objective, plan, step, self.knowledge, section)
 
+    def pick_knowledge(self, step: str, section: str) -> WriterKnowledgeResponse:
+        """Picks the results of the investigations most similar to the section instead of asking the model."""
+        embedder = self.vector_store.embedder
+        keys = list(self.knowledge.keys())
+        missing = [key for key in keys if key not in self._knowledge_vectors]
+        if missing:
+            vectors = normalize(embedder([f"{key}\n{self.knowledge[key]}" for key in missing]))
+            self._knowledge_vectors.update(zip(missing, vectors))
+
+        query = normalize(embedder([f"{section}\n{step}"]))[0]
+        similarities = np.array([self._knowledge_vectors[key] @ query for key in keys])
+        best = np.argsort(-similarities)[:self.knowledge_top_k]
+        return WriterKnowledgeResponse([keys[index] for index in best])
+
+    def knowledge_path(self) -> str:
+        return os.path.join(self.run.directory, "knowledge.jsonl.gz")
+
+    def load_knowledge(self):
+        """Loads the knowledge base saved by a previous run, the investigations finished after it are in the journal."""
+        path = self.knowledge_path()
+        if not os.path.isfile(path):
+            return
+        self.knowledge = KnowledgeStore.load(path, count_tokens=self.count_tokens,
+                                             fragment_tokens=self.knowledge.fragment_tokens)
+        logger.info(f"The knowledge base of {len(self.knowledge)} investigations is loaded from `{path}`")
+
     def dump_knowledge(self):
-        knowledge_json = json.dumps(self.knowledge, indent=4, ensure_ascii=False)
-        logger.debug(f"Resulting knowledge: {knowledge_json}")
+        path = self.knowledge_path()
+        self.knowledge.save(path)
+        logger.info(f"The knowledge base of {len(self.knowledge.fragments)} fragments from {len(self.knowledge)} "
+                    f"investigations is saved to `{path}`")
+
+    def write_document(self, objective: str, plan: str, item: PlanItem):
+        goal = item.goal
+        doc_structure = self.run.structures.get(goal)
+        if doc_structure is None:
+            doc_structure = self.write_document_structure(objective=objective, plan=plan, step=goal)
+            self.run.save_structure(goal, doc_structure)
+        logger.info(f"{item.label} I will generate document `{doc_structure.title}` with sections: "
+                    f"{', '.join(doc_structure.sections)}")
+
+        doc_filename = f"{doc_structure.title}.md"
+        if os.path.isfile(doc_filename):
+            logger.warning(f"{item.label} File `{doc_filename}` already exists. I will overwrite it.")
+
+        def what_is_needed(section: str) -> list[str]:
+            logger.info(f"{item.label} I'm thinking about section `{section}`")
+            i_want_to_know = self.what_should_i_know(objective=objective,
+                                                     plan=plan,
+                                                     step=goal,
+                                                     section=section).need_more_data
+            logger.info(f"{item.label} I'm generating content for the section `{section}` using the results "
+                        f"of the steps: {', '.join(i_want_to_know)}")
+            return i_want_to_know
+
+        def write_section(section: str) -> str:
+            doc_section = self.run.section(goal, section)
+            if doc_section is not None:
+                logger.info(f"{item.label} I've already written the section `{section}`.")
+                return doc_section
+
+            doc_section = self.write_document_section(objective=objective,
+                                                      plan=plan,
+                                                      step=goal,
+                                                      required_knowledge=what_is_needed(section),
+                                                      section=section)
+            logger.info(f"{item.label} I've finished writing the section `{section}`.")
+            self.run.save_section(goal, section, doc_section)
+            return doc_section
+
+        if self.stream:
+            self.stream_document(item, doc_filename, doc_structure.sections, what_is_needed,
+                                 lambda section, required_knowledge: self.section_writer.stream(
+                                     objective=objective,
+                                     plan=plan,
+                                     step=goal,
+                                     section=section,
+                                     knowledge=self.section_knowledge(objective, plan, goal, required_knowledge,
+                                                                      section)))
+            logger.info(f"{item.label} I've written the document `{doc_filename}`.")
+            return
+
+        with ThreadPoolExecutor(max_workers=self.chat_model.max_in_flight) as pool:
+            doc_sections = list(pool.map(metrics.bind(write_section), doc_structure.sections))
+
+        # assemble the sections in the declared order and replace the document at once
+        tmp_filename = f"{os.path.abspath(doc_filename)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        # created with the permissions of a new file under the umask, as the streamed documents are
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as doc_file:
+                for doc_section in doc_sections:
+                    doc_file.write('\n\n')
+                    doc_file.write(doc_section)
+            os.replace(tmp_filename, doc_filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        logger.info(f"{item.label} I've written the document `{doc_filename}`.")
 
-    def execute(self, objective: str):
+    def stream_document(self,
+                        item: PlanItem,
+                        doc_filename: str,
+                        sections: list[str],
+                        what_is_needed: Callable[[str], list[str]],
+                        stream_section: Callable[[str, list[str]], Iterator[str]]):
+        """Writes the sections into the document in their order as their text arrives from the model."""
+        with StreamingDocument(doc_filename, len(sections)) as document:
+            def write_section(index: int):
+                section = sections[index]
+                document.write(index, '\n\n')
+                doc_section = self.run.section(item.goal, section)
+                if doc_section is not None:
+                    logger.info(f"{item.label} I've already written the section `{section}`.")
+                    document.write(index, doc_section)
+                else:
+                    # the text is spooled for the run journal until the section is finished
+                    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+                        for part in stream_section(section, what_is_needed(section)):
+                            document.write(index, part)
+                            spool.write(part)
+                        logger.info(f"{item.label} I've finished writing the section `{section}`.")
+                        self.run.save_section_file(item.goal, section, spool)
+                document.finish(index)
+
+            with ThreadPoolExecutor(max_workers=self.chat_model.max_in_flight) as pool:
+                list(pool.map(metrics.bind(write_section), range(len(sections))))
+
+    def execute_plan_item(self, objective: str, plan: str, item: PlanItem):
+        with metrics.plan_item(f"{item.label} {item.goal}"):
+            if item.action.action == 'investigate':
+                if item.goal in self.run.knowledge:
+                    logger.info(f"{item.label} I've already investigated `{item.goal}`")
+                    if item.goal not in self.knowledge:
+                        self.knowledge[item.goal] = self.run.knowledge[item.goal]
+                    return
+                logger.info(f"{item.label} I'm investigating `{item.goal}`")
+                self.knowledge[item.goal] = self.investigate(item.goal)
+                self.run.save_knowledge(item.goal, self.knowledge[item.goal])
+                logger.info(f"{item.label} I've finished the investigation")
+            elif item.action.action in WRITING_ACTIONS:
+                self.write_document(objective=objective, plan=plan, item=item)
+
+    def execute(self, objective: str, run_dir: Optional[str] = None, resume: bool = False):
         logger.info("Starting...")
 
+        self.run = RunState(directory=run_dir or default_run_dir(objective), objective=objective, resume=resume)
+        objective = self.run.objective
+        logger.info(f"The progress of the run is saved to `{self.run.directory}`")
+        if resume:
+            self.load_knowledge()
+
         plan, plan_items = self.prepare_plan(objective=objective)
         logger.info(plan)
 
-        for goal in plan_items:
-            logger.info(f"I'm thinking about goal `{goal}`")
-            item_action = self.what_should_i_do(plan=plan, goal=goal)
-            logger.info(f"My thought is: `{item_action.response}`")
-            logger.info(f"I've decided to perform action `{item_action.action}`")
-
-            if item_action.action == 'investigate':
-                self.knowledge[goal] = self.investigate(goal)
-            elif item_action.action == 'feature' or item_action.action == 'report':
-                doc_structure = self.write_document_structure(objective=objective, plan=plan, step=goal)
-                logger.info(f"I will generate document `{doc_structure.title}` with sections: "
-                            f"{', '.join(doc_structure.sections)}")
-
-                doc_filename = f"{doc_structure.title}.md"
-                # delete file if exists
-                if os.path.isfile(doc_filename):
-                    logger.warning(f"File `{doc_filename}` already exists. I will delete it.")
-                    os.remove(doc_filename)
-
-                # write file
-                for section in doc_structure.sections:
-                    logger.info(f"I'm thinking about section `{section}`")
-                    i_want_to_know = self.what_should_i_know(objective=objective,
-                                                             plan=plan,
-                                                             step=goal,
-                                                             section=section).need_more_data
-                    logger.info(
-                        f"I'm generating content for the section using the results of the steps: {', '.join(i_want_to_know)}")
-                    doc_section = self.write_document_section(objective=objective,
-                                                              plan=plan,
-                                                              step=goal,
-                                                              required_knowledge=i_want_to_know,
-                                                              section=section)
-
-                    logger.info(f"I've finished writing this section and I'm adding it to the document.")
-                    with open(doc_filename, "a", encoding="utf-8") as doc_file:
-                        doc_file.write('\n\n')
-                        doc_file.write(doc_section)
+        items = [PlanItem(index=index, goal=goal) for index, goal in enumerate(plan_items)]
+        actions: list[Optional[ActionResponse]] = [self.run.actions.get(item.goal) for item in items]
+        undecided = [index for index, action in enumerate(actions) if action is None]
+        if self.batch and undecided:
+            responses = self.infer_in_batch(self.action.chat_model,
+                                            [self.action.render(plan, items[index].goal) for index in undecided],
+                                            self.action.validate_response)
+            for index, action in zip(undecided, responses):
+                actions[index] = action
+
+        def decide(item: PlanItem, action: Optional[ActionResponse]) -> ActionResponse:
+            with metrics.plan_item(f"{item.label} {item.goal}"):
+                return action or self.what_should_i_do(plan=plan, goal=item.goal)
+
+        with ThreadPoolExecutor(max_workers=self.chat_model.max_in_flight) as pool:
+            actions = list(pool.map(decide, items, actions))
+        for item, item_action in zip(items, actions):
+            if item.goal not in self.run.actions:
+                self.run.save_action(item.goal, item_action)
+
+        for item, item_action in zip(items, actions):
+            item.action = item_action
+            logger.info(f"{item.label} I'm thinking about goal `{item.goal}`")
+            logger.info(f"{item.label} My thought is: `{item_action.response}`")
+            logger.info(f"{item.label} I've decided to perform action `{item_action.action}`")
+
+        self.fused_goals = [item.goal for item in items
+                            if item.action.action == 'investigate' and item.goal not in self.run.knowledge]
+        link_plan_items(items)
+        scheduler = PlanScheduler(max_workers=self.plan_workers)
+        scheduler.run(items, lambda item: self.execute_plan_item(objective=objective, plan=plan, item=item))
 
         self.dump_knowledge()
+        logger.info(f"Token usage: {self.chat_model.usage}" if not self.models.is_routed() else
+                    f"Token usage:\n{self.models.usage()}")
+        if escalations := self.models.escalations():
+            logger.info(f"Model routing:\n{escalations}")
+        logger.info(f"Response cache: {self.chat_model.cache}")
+        logger.info(f"Structured responses: {structured_output}")
+        logger.info(f"Research drafts: {self.drafts}")
+        logger.info(f"Metrics:\n{metrics.table()}")
+        metrics.export(json_path=os.getenv("BRAN_METRICS_JSON"), prometheus_path=os.getenv("BRAN_METRICS_PROMETHEUS"))
+        self.run.close()
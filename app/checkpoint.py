@@ -0,0 +1,161 @@
+#
+# Progress of a run, persisted to resume it after a failure
+#
+
+import hashlib
+import json
+import os
+import threading
+from typing import IO, Optional
+
+from app.agents.action.action import ActionResponse
+from app.agents.writer import StructureResponse
+
+
+def default_run_dir(objective: str) -> str:
+    runs_dir = os.getenv("BRAN_RUNS_DIR", "runs")
+    return os.path.join(runs_dir, hashlib.sha256(objective.strip().encode("utf-8")).hexdigest()[:12])
+
+
+class RunState:
+    """
+    Progress of a run: the plan, the decisions about the plan items, the research drafts of every piece
+    of the documentation, the results of the investigations, the structures of the documents and
+    the finished document sections.
+
+    Every step is appended as a JSON line to the journal in the run directory, so the progress survives a crash
+    and the journal is replayed when the run is resumed. Without a directory the progress is kept in memory only.
+    """
+
+    JOURNAL_FILE = "journal.jsonl"
+
+    def __init__(self, directory: Optional[str] = None, objective: str = "", resume: bool = False):
+        self.directory = directory
+        self.objective = objective
+        self.plan: Optional[str] = None
+        self.plan_items: Optional[list[str]] = None
+        self.actions: dict[str, ActionResponse] = {}
+        # goal -> investigation mode -> index of the piece -> draft record
+        self.research: dict[str, dict[str, dict[int, dict]]] = {}
+        self.knowledge: dict[str, str] = {}
+        # plan step -> structure of the document
+        self.structures: dict[str, StructureResponse] = {}
+        # plan step -> section -> text, or the byte offset of the record of a section saved from a file
+        self.sections: dict[str, dict[str, str | int]] = {}
+        self._lock = threading.Lock()
+        self._journal = None
+
+        if directory is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.JOURNAL_FILE)
+        resumed = resume and os.path.isfile(path)
+        # a journal written before the objective record could be flushed has no objective
+        journaled = resumed and self._replay(path)
+        if not self.objective:
+            raise ValueError(f"There is no run to resume in {directory}")
+        self._journal = open(path, "a" if resumed else "w", encoding="utf-8")
+        if not journaled:
+            self._append({"type": "objective", "objective": self.objective})
+
+    def _replay(self, path: str) -> bool:
+        """Applies the records of the journal, returns whether it has the objective of the run."""
+        has_objective = False
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be incomplete if the run has been interrupted
+                    continue
+                self._apply(record)
+                has_objective = has_objective or record["type"] == "objective"
+        return has_objective
+
+    def _apply(self, record: dict):
+        kind = record["type"]
+        if kind == "objective":
+            self.objective = record["objective"]
+        elif kind == "plan":
+            self.plan = record["plan"]
+            self.plan_items = record["plan_items"]
+        elif kind == "action":
+            self.actions[record["goal"]] = ActionResponse(record["response"], record["action"])
+        elif kind == "draft":
+            drafts = self.research.setdefault(record["goal"], {}).setdefault(record["mode"], {})
+            drafts[record["index"]] = record
+        elif kind == "knowledge":
+            self.knowledge[record["goal"]] = record["result"]
+        elif kind == "structure":
+            self.structures[record["step"]] = StructureResponse(record["title"], record["sections"])
+        elif kind == "section":
+            self.sections.setdefault(record["step"], {})[record["section"]] = record["text"]
+
+    def _append(self, record: dict):
+        with self._lock:
+            self._apply(record)
+            if self._journal is not None:
+                self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._journal.flush()
+
+    @property
+    def is_persistent(self) -> bool:
+        return self._journal is not None
+
+    def save_plan(self, plan: str, plan_items: list[str]):
+        self._append({"type": "plan", "plan": plan, "plan_items": plan_items})
+
+    def save_action(self, goal: str, action: ActionResponse):
+        self._append({"type": "action", "goal": goal, "response": action.response, "action": action.action})
+
+    def save_draft(self, goal: str, mode: str, index: int, draft: str, **extra):
+        self._append(dict({"type": "draft", "goal": goal, "mode": mode, "index": index, "draft": draft}, **extra))
+
+    def drafts(self, goal: str, mode: str) -> dict[int, dict]:
+        with self._lock:
+            return dict(self.research.get(goal, {}).get(mode, {}))
+
+    def save_knowledge(self, goal: str, result: str):
+        self._append({"type": "knowledge", "goal": goal, "result": result})
+
+    def save_structure(self, step: str, structure: StructureResponse):
+        self._append({"type": "structure", "step": step, "title": structure.title, "sections": structure.sections})
+
+    def save_section(self, step: str, section: str, text: str):
+        self._append({"type": "section", "step": step, "section": section, "text": text})
+
+    def save_section_file(self, step: str, section: str, file: IO[str]):
+        """
+        Saves the text of a section spooled to a file, e.g. while it has been streamed. The text is copied
+        into the journal piece by piece and is not kept in memory.
+        """
+        with self._lock:
+            if self._journal is None:
+                file.seek(0)
+                self.sections.setdefault(step, {})[section] = file.read()
+                return
+            self._journal.flush()
+            offset = os.fstat(self._journal.fileno()).st_size
+            record = json.dumps({"type": "section", "step": step, "section": section}, ensure_ascii=False)
+            self._journal.write(record[:-1] + ', "text": "')
+            file.seek(0)
+            while text := file.read(64 * 1024):
+                self._journal.write(json.dumps(text, ensure_ascii=False)[1:-1])
+            self._journal.write('"}\n')
+            self._journal.flush()
+            # the section is complete, its text is read back from the journal when it is needed
+            self.sections.setdefault(step, {})[section] = offset
+
+    def section(self, step: str, section: str) -> Optional[str]:
+        with self._lock:
+            text = self.sections.get(step, {}).get(section)
+            if isinstance(text, int):
+                with open(os.path.join(self.directory, self.JOURNAL_FILE), "rb") as f:
+                    f.seek(text)
+                    text = json.loads(f.readline())["text"]
+            return text
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,6 @@
+from .chunker import Chunk, TokenChunker
+from .index import ChunkIndex
+from .retrieval import BM25Index, with_neighbors
+from .sources import chunk_files, create_chunker, resolve_sources
+from .stream import ChunkStream, has_item
+from .vectors import HashingEmbedder, OpenAIEmbedder, VectorStore
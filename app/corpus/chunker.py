@@ -0,0 +1,117 @@
+#
+# Splits a text file into chunks of sentences that fit a token budget
+#
+
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+import tiktoken
+from spacy.language import Language
+
+
+@dataclass(frozen=True)
+class Chunk:
+    text: str
+    tokens: int
+    # the file of the chunk and the character offset of its first sentence, for citations
+    source: str = ""
+    offset: int = 0
+
+
+class TokenChunker:
+    """
+    Reads a text file block by block, splits the blocks into sentences lazily and packs the sentences
+    into chunks of at most `max_tokens` tokens. The last sentences of a chunk, up to `overlap` tokens,
+    are repeated at the beginning of the next one.
+    """
+
+    def __init__(self,
+                 nlp: Language,
+                 encoding: tiktoken.Encoding,
+                 max_tokens: int = 1024,
+                 overlap: int = 0,
+                 block_size: int = 256 * 1024):
+        if overlap >= max_tokens:
+            raise ValueError(f'Overlap must be less than the chunk size: {overlap} >= {max_tokens}')
+        self.nlp = nlp
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.block_size = block_size
+
+    def read_blocks(self, path: str) -> Iterator[str]:
+        """Reads the file incrementally and cuts it at line breaks, so the sentences are not torn apart."""
+        with open(path, "r", encoding="utf-8") as f:
+            rest = ""
+            while True:
+                data = f.read(self.block_size)
+                if not data:
+                    break
+                text = rest + data
+                cut = text.rfind("\n\n")
+                if cut <= 0:
+                    cut = text.rfind("\n")
+                if cut <= 0 and len(text) < 4 * self.block_size:
+                    rest = text
+                    continue
+                if cut <= 0:
+                    cut = len(text)
+                yield text[:cut]
+                rest = text[cut:]
+            if rest.strip():
+                yield rest
+
+    def sentences(self, blocks: Iterable[str]) -> Iterator[tuple[str, int]]:
+        """Yields the sentences together with their character offsets in the text of all blocks."""
+        block_offset = 0
+        lengths = []
+
+        def measured(blocks: Iterable[str]) -> Iterator[str]:
+            for block in blocks:
+                lengths.append(len(block))
+                yield block
+
+        for doc in self.nlp.pipe(measured(blocks)):
+            for sent in doc.sents:
+                text = str(sent)
+                sentence = text.strip()
+                if sentence:
+                    yield sentence, block_offset + sent.start_char + len(text) - len(text.lstrip())
+            block_offset += lengths.pop(0)
+
+    def _split_long_sentence(self, sentence: str, tokens: list[int]) -> Iterator[tuple[str, int]]:
+        for i in range(0, len(tokens), self.max_tokens - 1):
+            piece = tokens[i: i + self.max_tokens - 1]
+            yield self.encoding.decode(piece), len(piece)
+
+    def pack(self, sentences: Iterable[tuple[str, int]], source: str = "") -> Iterator[Chunk]:
+        window: list[tuple[str, int, int]] = []
+        size = 0
+        fresh = False
+
+        def chunk() -> Chunk:
+            return Chunk("\n".join(text for text, _, _ in window), size, source=source, offset=window[0][2])
+
+        for sentence, offset in sentences:
+            tokens = self.encoding.encode(sentence, disallowed_special=())
+            if len(tokens) < self.max_tokens:
+                parts = [(sentence, len(tokens))]
+            else:
+                parts = self._split_long_sentence(sentence, tokens)
+
+            for text, count in parts:
+                # every sentence costs one more token for the line break that joins it to the chunk
+                if fresh and size + count + 1 > self.max_tokens:
+                    yield chunk()
+                    fresh = False
+                    while window and (size > self.overlap or size + count + 1 > self.max_tokens):
+                        size -= window.pop(0)[1] + 1
+                window.append((text, count, offset))
+                size += count + 1
+                fresh = True
+
+        if fresh:
+            yield chunk()
+
+    def chunks(self, path: str) -> Iterator[Chunk]:
+        return self.pack(self.sentences(self.read_blocks(path)), source=path)
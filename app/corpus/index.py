@@ -0,0 +1,173 @@
+#
+# On-disk index of the chunks of a document
+#
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from array import array
+from typing import Callable, Iterable, Optional, Sequence
+
+from .chunker import Chunk
+
+INDEX_VERSION = 2
+
+
+def file_digest(path: str) -> str:
+    """Returns the SHA-256 of the file content."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class ChunkIndex(Sequence[str]):
+    """
+    Chunks of a document stored in a directory: the texts are concatenated in one UTF-8 file, which is memory-mapped,
+    the byte offsets of the chunks, their sizes in tokens, their source files and their character offsets
+    in the source files are kept in compact binary arrays.
+    """
+
+    TEXT_FILE = "chunks.txt"
+    OFFSETS_FILE = "offsets.bin"
+    TOKENS_FILE = "tokens.bin"
+    SOURCES_FILE = "sources.bin"
+    POSITIONS_FILE = "positions.bin"
+    META_FILE = "meta.json"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, self.META_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        self._offsets = array("q")
+        with open(os.path.join(directory, self.OFFSETS_FILE), "rb") as f:
+            self._offsets.frombytes(f.read())
+        self._tokens = array("i")
+        with open(os.path.join(directory, self.TOKENS_FILE), "rb") as f:
+            self._tokens.frombytes(f.read())
+        self._sources = array("i")
+        with open(os.path.join(directory, self.SOURCES_FILE), "rb") as f:
+            self._sources.frombytes(f.read())
+        self._positions = array("q")
+        with open(os.path.join(directory, self.POSITIONS_FILE), "rb") as f:
+            self._positions.frombytes(f.read())
+
+        self._file = open(os.path.join(directory, self.TEXT_FILE), "rb")
+        if self._offsets[-1] > 0:
+            self._text = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._text = b""
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        return self._text[self._offsets[index]: self._offsets[index + 1]].decode("utf-8")
+
+    def tokens(self, index: int) -> int:
+        return self._tokens[index]
+
+    def source(self, index: int) -> tuple[str, int]:
+        """Returns the source file of the chunk and the character offset of the chunk in it."""
+        return self.meta["sources"][self._sources[index]], self._positions[index]
+
+    def close(self):
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        self._file.close()
+
+    @classmethod
+    def build(cls, directory: str, chunks: Iterable[Chunk], meta: dict,
+              written: Optional[Callable[[int, str, int, int], None]] = None) -> "ChunkIndex":
+        """
+        Builds the index from the chunks. `written(index, path, start, end)` is called when a chunk is flushed
+        to the bytes `start:end` of the text file, so it can be read back while the index is built.
+        """
+        tmp_directory = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp_directory, exist_ok=True)
+
+        offsets = array("q", [0])
+        tokens = array("i")
+        sources = array("i")
+        positions = array("q")
+        source_ids = {source: index for index, source in enumerate(meta.get("sources", []))}
+        text_path = os.path.join(tmp_directory, cls.TEXT_FILE)
+        with open(text_path, "wb") as text_file:
+            for chunk in chunks:
+                data = chunk.text.encode("utf-8")
+                text_file.write(data)
+                offsets.append(offsets[-1] + len(data))
+                if written is not None:
+                    text_file.flush()
+                    written(len(offsets) - 2, text_path, offsets[-2], offsets[-1])
+                tokens.append(chunk.tokens)
+                sources.append(source_ids.setdefault(chunk.source, len(source_ids)))
+                positions.append(chunk.offset)
+        for name, values in ((cls.OFFSETS_FILE, offsets), (cls.TOKENS_FILE, tokens), (cls.SOURCES_FILE, sources),
+                             (cls.POSITIONS_FILE, positions)):
+            with open(os.path.join(tmp_directory, name), "wb") as f:
+                values.tofile(f)
+        meta = dict(meta, sources=list(source_ids))
+        with open(os.path.join(tmp_directory, cls.META_FILE), "w", encoding="utf-8") as f:
+            json.dump(dict(meta, chunks=len(tokens)), f, ensure_ascii=False, indent=4)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+        return cls(directory)
+
+    @classmethod
+    def locate(cls, cache_dir: str, name: str, source_paths: list[str], params: dict) -> tuple[str, dict]:
+        """
+        Returns the directory of the index of the source files built with the chunking parameters and its metadata.
+        The files are hashed again only when their size or modification time changes, indexes of the previous
+        versions of the files are removed.
+        """
+        source_dir = os.path.join(cache_dir, hashlib.sha1(os.path.abspath(name).encode("utf-8")).hexdigest()[:16])
+        os.makedirs(source_dir, exist_ok=True)
+
+        source_file = os.path.join(source_dir, "source.json")
+        try:
+            with open(source_file, "r", encoding="utf-8") as f:
+                known = json.load(f).get("files", {})
+        except (OSError, ValueError):
+            known = {}
+        files = {}
+        for path in source_paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            file = known.get(path, {})
+            if file.get("size") != stat.st_size or file.get("mtime_ns") != stat.st_mtime_ns:
+                file = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(path)}
+            files[path] = file
+        if files != known:
+            with open(source_file, "w", encoding="utf-8") as f:
+                json.dump({"path": name, "files": files}, f, indent=4)
+
+        sha256 = hashlib.sha256()
+        for path, file in files.items():
+            sha256.update(f"{path}\0{file['sha256']}\n".encode("utf-8"))
+        meta = {"version": INDEX_VERSION, "source": name, "sha256": sha256.hexdigest(), "params": params,
+                "sources": list(files)}
+        key = hashlib.sha256(json.dumps(meta, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+        directory = os.path.join(source_dir, key)
+
+        if not cls.exists(directory):
+            for entry in os.listdir(source_dir):
+                path = os.path.join(source_dir, entry)
+                if os.path.isdir(path) and entry != key:
+                    shutil.rmtree(path, ignore_errors=True)
+        return directory, meta
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.isfile(os.path.join(directory, cls.META_FILE))
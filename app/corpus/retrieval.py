@@ -0,0 +1,90 @@
+#
+# Lexical retrieval of the chunks relevant to a query
+#
+
+import re
+from collections import Counter
+from typing import Iterable, Sequence
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def with_neighbors(indices: Iterable[int], neighbors: int, total: int) -> list[int]:
+    """Adds `neighbors` indices on each side of the given ones and returns all of them in order."""
+    selected = set()
+    for index in indices:
+        selected.update(range(max(0, index - neighbors), min(total, index + neighbors + 1)))
+    return sorted(selected)
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a sequence of documents. The term frequencies are kept as a sparse term-document matrix
+    in the compressed sparse column layout: the postings of the term `t` are `indices[indptr[t]:indptr[t + 1]]`
+    with the frequencies in `data` at the same positions.
+    """
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary: dict[str, int] = {}
+
+        terms: list[int] = []
+        docs: list[int] = []
+        counts: list[int] = []
+        lengths: list[int] = []
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            lengths.append(len(tokens))
+            for token, count in Counter(tokens).items():
+                terms.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                docs.append(doc_id)
+                counts.append(count)
+
+        terms_array = np.array(terms, dtype=np.int32)
+        order = np.argsort(terms_array, kind="stable")
+        self.indices = np.array(docs, dtype=np.int32)[order]
+        self.data = np.array(counts, dtype=np.float32)[order]
+        document_frequency = np.bincount(terms_array, minlength=len(self.vocabulary))
+        self.indptr = np.concatenate(([0], np.cumsum(document_frequency))).astype(np.int64)
+
+        self.doc_lengths = np.array(lengths, dtype=np.float32)
+        self.avg_doc_length = float(self.doc_lengths.mean()) if len(lengths) and self.doc_lengths.any() else 1.0
+        n = len(lengths)
+        self.idf = np.log1p((n - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self), dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / self.avg_doc_length)
+        for token in set(tokenize(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.indptr[term], self.indptr[term + 1]
+            docs = self.indices[start:end]
+            tf = self.data[start:end]
+            scores[docs] += self.idf[term] * tf * (self.k1 + 1) / (tf + norm[docs])
+        return scores
+
+    def top_k(self, query: str, k: int, neighbors: int = 0) -> tuple[list[int], np.ndarray]:
+        """
+        Returns the indices of the `k` best matching documents together with their `neighbors` on each side,
+        in the document order, and the scores of all documents.
+        """
+        scores = self.scores(query)
+        matching = int(np.count_nonzero(scores))
+        k = min(k, matching)
+        if k == 0:
+            return [], scores
+
+        best = np.argpartition(-scores, k - 1)[:k]
+        return with_neighbors(best.tolist(), neighbors, len(self)), scores
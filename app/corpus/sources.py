@@ -0,0 +1,91 @@
+#
+# Text files of the documentation and their parallel chunking
+#
+
+import glob
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional
+
+import tiktoken
+from spacy.language import Language
+from spacy.lang.en import English
+from spacy.lang.ru import Russian
+
+from .chunker import Chunk, TokenChunker
+
+TEXT_EXTENSIONS = (".md", ".markdown", ".txt", ".rst")
+
+
+def resolve_sources(data_path: str) -> list[str]:
+    """
+    Returns the files of the documentation: the file itself, the text files of a directory and its subdirectories,
+    or the files matching a glob pattern, in the order of their paths.
+    """
+    if os.path.isdir(data_path):
+        paths = []
+        for root, dirs, files in os.walk(data_path):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            paths.extend(os.path.join(root, name) for name in files
+                         if name.lower().endswith(TEXT_EXTENSIONS) and not name.startswith("."))
+    elif glob.has_magic(data_path):
+        paths = [path for path in glob.glob(data_path, recursive=True) if os.path.isfile(path)]
+    else:
+        paths = [data_path]
+    if not paths:
+        raise FileNotFoundError(f"There are no text files in {data_path}")
+    return sorted(os.path.abspath(path) for path in paths)
+
+
+def create_nlp(language: str) -> Language:
+    if language == 'Russian':
+        nlp = Russian()
+    elif language == 'English':
+        nlp = English()
+    # add more languages as needed
+    else:
+        raise ValueError(f'Unsupported language: {language}')
+    nlp.add_pipe('sentencizer')
+    return nlp
+
+
+def create_chunker(language: str, encoding: str, max_tokens: int, overlap: int) -> TokenChunker:
+    return TokenChunker(nlp=create_nlp(language),
+                        encoding=tiktoken.get_encoding(encoding),
+                        max_tokens=max_tokens,
+                        overlap=overlap)
+
+
+_worker_chunker: Optional[TokenChunker] = None
+
+
+def _init_worker(params: dict):
+    global _worker_chunker
+    _worker_chunker = create_chunker(**params)
+
+
+def _chunk_file(path: str) -> list[Chunk]:
+    return list(_worker_chunker.chunks(path))
+
+
+def chunk_files(paths: list[str], params: dict, workers: int = 0) -> Iterator[Chunk]:
+    """
+    Yields the chunks of the files in their order, `params` are the arguments of `create_chunker`.
+    Several files are parsed by a pool of `workers` processes, and the chunks of a file are yielded as soon as
+    it and all files before it are parsed.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    if workers <= 1:
+        chunker = create_chunker(**params)
+        for path in paths:
+            yield from chunker.chunks(path)
+        return
+
+    # the workers are spawned, forking a process with running threads is not safe
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(params,)) as pool:
+        for chunks in pool.map(_chunk_file, paths):
+            yield from chunks
@@ -0,0 +1,130 @@
+#
+# Pieces of the documentation available while the documentation is still being split
+#
+
+import threading
+from typing import IO, Iterable, Iterator, Optional, Sequence
+
+from .chunker import Chunk
+
+
+def has_item(items: Sequence, index: int) -> bool:
+    """Whether the sequence has the index, a stream is waited for until it has it or it is complete."""
+    if isinstance(items, ChunkStream):
+        return items.wait_for(index)
+    return index < len(items)
+
+
+class ChunkStream(Sequence[str]):
+    """
+    Texts of the chunks appended by a producer thread and read by any number of consumers. Reading an item
+    which hasn't been produced yet waits for it, the length is known only when the stream is complete.
+
+    Only the texts of the chunks which haven't been written to the index yet are kept in memory: the written ones
+    are read back from the text file of the index being built, see `written`, and from the index itself once
+    the stream is complete.
+    """
+
+    def __init__(self):
+        self._count = 0
+        # texts of the chunks produced but not written to the index yet
+        self._pending: dict[int, str] = {}
+        # byte ranges of the written chunks in the text file of the index
+        self._ranges: dict[int, tuple[int, int]] = {}
+        self._reader: Optional[IO[bytes]] = None
+        self._index: Optional[Sequence[str]] = None
+        self._complete = False
+        self._error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+
+    def tee(self, chunks: Iterable[Chunk]) -> Iterator[Chunk]:
+        """
+        Passes the chunks through, appending their texts to the stream. The stream is completed with the error
+        if the chunks fail, otherwise the caller completes it when the chunks are stored.
+        """
+        try:
+            for chunk in chunks:
+                with self._condition:
+                    self._pending[self._count] = chunk.text
+                    self._count += 1
+                    self._condition.notify_all()
+                yield chunk
+        except BaseException as e:
+            self.complete(e)
+            raise
+
+    def written(self, index: int, path: str, start: int, end: int):
+        """Records that the chunk has been written to the bytes `start:end` of the file, its text is released."""
+        with self._condition:
+            if self._reader is None:
+                self._reader = open(path, "rb")
+            self._ranges[index] = (start, end)
+            self._pending.pop(index, None)
+
+    def complete(self, error: Optional[BaseException] = None, index: Optional[Sequence[str]] = None):
+        """Completes the stream, the chunks are read from the `index` built from it from now on."""
+        with self._condition:
+            self._complete = True
+            self._error = error
+            if index is not None:
+                self._index = index
+                self._pending.clear()
+                self._ranges.clear()
+                if self._reader is not None:
+                    self._reader.close()
+                    self._reader = None
+            self._condition.notify_all()
+
+    def wait_for(self, index: int) -> bool:
+        """Waits until the item at the index is produced or the stream is complete, returns whether it exists."""
+        with self._condition:
+            self._condition.wait_for(lambda: index < self._count or self._complete)
+            if index >= self._count and self._error is not None:
+                raise self._error
+            return index < self._count
+
+    def wait(self):
+        """Waits until the stream is complete."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._complete)
+            if self._error is not None:
+                raise self._error
+
+    def _text(self, index: int) -> str:
+        with self._condition:
+            if self._index is not None:
+                return self._index[index]
+            if index in self._pending:
+                return self._pending[index]
+            start, end = self._ranges[index]
+            self._reader.seek(start)
+            return self._reader.read(end - start).decode("utf-8")
+
+    def __len__(self) -> int:
+        self.wait()
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is not None and index.stop >= 0 and (index.start or 0) >= 0 and index.step in (None, 1):
+                # a forward slice waits only for its last item
+                self.wait_for(index.stop - 1)
+                with self._condition:
+                    return [self._text(i) for i in range(*index.indices(self._count))]
+            self.wait()
+            return [self._text(i) for i in range(*index.indices(self._count))]
+        if index < 0:
+            self.wait()
+            index += self._count
+            if index < 0:
+                raise IndexError("chunk index out of range")
+            return self._text(index)
+        if not self.wait_for(index):
+            raise IndexError("chunk index out of range")
+        return self._text(index)
+
+    def __iter__(self) -> Iterator[str]:
+        index = 0
+        while self.wait_for(index):
+            yield self._text(index)
+            index += 1
@@ -0,0 +1,137 @@
+#
+# Semantic retrieval of the chunks with embeddings
+#
+
+import hashlib
+import os
+import re
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+from openai import AzureOpenAI, OpenAI
+
+from .retrieval import tokenize
+
+# an embedder turns a batch of texts into a matrix with one row per text
+Embedder = Callable[[list[str]], np.ndarray]
+
+
+def embedder_name(embedder: Embedder) -> str:
+    return getattr(embedder, "name", type(embedder).__name__)
+
+
+class HashingEmbedder:
+    """
+    Deterministic offline embedder: the words and word bigrams of a text are hashed into a fixed number
+    of signed buckets. It needs no model and no network, so it is handy for testing and as a fallback.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                vectors[row, value % self.dim] += 1.0 if value >> 63 else -1.0
+        return vectors
+
+
+class OpenAIEmbedder:
+    def __init__(self, model_id: str, is_azure: bool = False):
+        self.client = AzureOpenAI() if is_azure else OpenAI()
+        self.model_id = model_id
+        self.name = model_id
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        response = self.client.embeddings.create(input=texts, model=self.model_id)
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorStore:
+    """
+    Normalized embeddings of the chunks as a float32 matrix. `open_or_build` saves the matrix as a `.npy` file
+    next to the chunk index, so the next runs memory-map it instead of computing the embeddings again.
+    """
+
+    def __init__(self, matrix: np.ndarray, embedder: Embedder):
+        self.matrix = matrix
+        self.embedder = embedder
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @staticmethod
+    def _embed(documents: Sequence[str], embedder: Embedder, batch_size: int, out: Optional[np.ndarray] = None):
+        batches = []
+        for start in range(0, len(documents), batch_size):
+            batch = normalize(embedder(list(documents[start: start + batch_size])))
+            if out is None:
+                batches.append(batch)
+            else:
+                out[start: start + len(batch)] = batch
+        return np.concatenate(batches) if out is None else out
+
+    @classmethod
+    def build(cls, documents: Sequence[str], embedder: Embedder, batch_size: int = 64) -> "VectorStore":
+        if len(documents) == 0:
+            return cls(np.zeros((0, 0), dtype=np.float32), embedder)
+        return cls(cls._embed(documents, embedder, batch_size), embedder)
+
+    @classmethod
+    def open_or_build(cls,
+                      directory: str,
+                      documents: Sequence[str],
+                      embedder: Embedder,
+                      batch_size: int = 64) -> tuple["VectorStore", bool]:
+        """Opens the embeddings saved in the directory or computes and saves them. Returns whether they are reused."""
+        name = re.sub(r"[^\w.-]+", "_", embedder_name(embedder))
+        path = os.path.join(directory, f"vectors-{name}.npy")
+        if os.path.isfile(path):
+            matrix = np.load(path, mmap_mode="r")
+            if matrix.shape[0] == len(documents):
+                return cls(matrix, embedder), True
+
+        if len(documents) == 0:
+            return cls.build(documents, embedder), False
+
+        first = normalize(embedder(list(documents[:batch_size])))
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                           shape=(len(documents), first.shape[1]))
+        matrix[:len(first)] = first
+        cls._embed(documents[len(first):], embedder, batch_size, out=matrix[len(first):])
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, path)
+        return cls(np.load(path, mmap_mode="r"), embedder), False
+
+    def search(self, query: str, k: int, block_size: int = 65536) -> list[tuple[int, float]]:
+        """Returns up to `k` pairs of the chunk index and its cosine similarity to the query, the best first."""
+        if len(self) == 0 or k <= 0:
+            return []
+        vector = normalize(self.embedder([query]))[0]
+
+        best_indices = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        # the matrix is scanned in blocks to keep the memory flat for memory-mapped embeddings
+        for start in range(0, len(self), block_size):
+            scores = np.asarray(self.matrix[start: start + block_size] @ vector)
+            indices = np.arange(start, start + len(scores))
+            best_indices = np.concatenate((best_indices, indices))
+            best_scores = np.concatenate((best_scores, scores))
+            if len(best_scores) > k:
+                top = np.argpartition(-best_scores, k - 1)[:k]
+                best_indices, best_scores = best_indices[top], best_scores[top]
+
+        order = np.argsort(-best_scores)
+        return [(int(best_indices[i]), float(best_scores[i])) for i in order]
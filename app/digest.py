@@ -0,0 +1,82 @@
+#
+# Summaries of the documentation which do not depend on the goal, built once and shared by all investigations
+#
+
+import json
+import os
+import re
+from typing import Callable, Iterable, Sequence
+
+Summarize = Callable[[str, str], str]
+Mapper = Callable[[Callable, Iterable], Iterable]
+
+
+class DocumentDigest:
+    """
+    Hierarchical summaries of the documentation. The first level has a summary of every piece, every next level
+    has a summary of each group of `fan_in` summaries of the level below, up to a single summary of the whole text.
+
+    The context of a piece is what has been read before it: the summaries of the largest groups that precede it,
+    so the distant text is summarized coarsely and the text right before the piece in detail.
+    """
+
+    def __init__(self, levels: list[list[str]], fan_in: int):
+        self.levels = levels
+        self.fan_in = fan_in
+
+    def __len__(self) -> int:
+        return len(self.levels[0]) if self.levels else 0
+
+    def context(self, index: int) -> str:
+        """Returns the summary of the text before the piece at `index`."""
+        parts = []
+        position = 0
+        for level in reversed(range(len(self.levels))):
+            size = self.fan_in ** level
+            while position + size <= index:
+                parts.append(self.levels[level][position // size])
+                position += size
+        return "\n".join(part for part in parts if part.strip())
+
+    @classmethod
+    def build(cls, pieces: Sequence[str], summarize: Summarize, fan_in: int, mapper: Mapper = map) -> "DocumentDigest":
+        """
+        Summarizes the pieces with `summarize(summary, new_lines)`. The summaries of one level are independent,
+        `mapper` may compute them concurrently.
+        """
+        def merge(group: list[str]) -> str:
+            if len(group) == 1:
+                return group[0]
+            return summarize(group[0], "\n".join(group[1:]))
+
+        levels = [list(mapper(lambda piece: summarize("", piece), pieces))]
+        while len(levels[-1]) > 1:
+            below = levels[-1]
+            levels.append(list(mapper(merge, [below[i: i + fan_in] for i in range(0, len(below), fan_in)])))
+        return cls(levels, fan_in)
+
+    @classmethod
+    def open_or_build(cls,
+                      directory: str,
+                      name: str,
+                      pieces: Sequence[str],
+                      summarize: Summarize,
+                      fan_in: int,
+                      mapper: Mapper = map) -> tuple["DocumentDigest", bool]:
+        """
+        Opens the digest saved next to the chunk index or builds and saves it. `name` tells apart the digests
+        made by different models or in different languages. Returns whether the digest is reused.
+        """
+        path = os.path.join(directory, "digest-" + re.sub(r"[^\w.-]+", "_", name) + ".json")
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+            if saved["fan_in"] == fan_in and saved["pieces"] == len(pieces):
+                return cls(saved["levels"], fan_in), True
+
+        digest = cls.build(pieces, summarize, fan_in, mapper)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"fan_in": fan_in, "pieces": len(pieces), "levels": digest.levels}, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return digest, False
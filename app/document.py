@@ -0,0 +1,60 @@
+#
+# Markdown document written while its sections are generated
+#
+
+import shutil
+import tempfile
+import threading
+from typing import IO, Optional
+
+
+class StreamingDocument:
+    """
+    Writes the sections of a document in their order while they are generated concurrently. The first unfinished
+    section goes straight into the document, the following ones are spooled to temporary files and copied
+    into the document when their turn comes, so neither the document nor the sections are kept in memory.
+    """
+
+    def __init__(self, path: str, sections: int):
+        self.path = path
+        self._file = open(path, "w", encoding="utf-8")
+        self._current = 0
+        self._spools: list[Optional[IO[str]]] = [None] * sections
+        self._finished = [False] * sections
+        self._lock = threading.Lock()
+
+    def write(self, index: int, text: str):
+        with self._lock:
+            if index == self._current:
+                self._file.write(text)
+                self._file.flush()
+            else:
+                if self._spools[index] is None:
+                    self._spools[index] = tempfile.TemporaryFile("w+", encoding="utf-8")
+                self._spools[index].write(text)
+
+    def finish(self, index: int):
+        with self._lock:
+            self._finished[index] = True
+            while self._current < len(self._finished) and self._finished[self._current]:
+                self._current += 1
+                if self._current < len(self._spools) and self._spools[self._current] is not None:
+                    spool = self._spools[self._current]
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, self._file)
+                    spool.close()
+                    self._spools[self._current] = None
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            for spool in self._spools:
+                if spool is not None:
+                    spool.close()
+            self._file.close()
+
+    def __enter__(self) -> "StreamingDocument":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,78 @@
+#
+# Research drafts of the pieces of the documentation, reused while the pieces do not change
+#
+
+import hashlib
+import json
+import threading
+from typing import Optional, Sequence
+
+from app.llm import ResponseCache
+
+
+def piece_digest(piece: str) -> str:
+    return hashlib.sha256(piece.encode("utf-8")).hexdigest()
+
+
+class DraftCache:
+    """
+    Research drafts keyed by the content of the pieces they have been made of, so only changed or added pieces
+    of an edited document are researched again.
+
+    In the sequential investigation a draft also depends on the summary of all previous pieces, which is represented
+    by the state: a hash chained over the digests of the pieces read so far. The chain of drafts is reused
+    up to the first changed piece and the summary is built again from there.
+    """
+
+    def __init__(self, store: ResponseCache, model_id: str):
+        self.store = store
+        self.model_id = model_id
+        self.reused = 0
+        self.researched = 0
+        self._lock = threading.Lock()
+
+    def initial_state(self, *params) -> str:
+        """Returns the state before the first piece, `params` are everything the research depends on."""
+        payload = json.dumps([self.model_id, *params], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def advance(state: str, pieces: Sequence[str]) -> str:
+        """Returns the state after reading the pieces."""
+        sha256 = hashlib.sha256(state.encode("utf-8"))
+        for piece in pieces:
+            sha256.update(piece_digest(piece).encode("utf-8"))
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _key(state: str, piece: str) -> str:
+        return hashlib.sha256(f"{state}:{piece_digest(piece)}".encode("utf-8")).hexdigest()
+
+    def get(self, state: str, pieces: Sequence[str], index: int) -> Optional[dict]:
+        """
+        Returns the draft record of the piece at `index`: the draft, the summary after it and the digests
+        of the pieces it has been made of. A draft of several pieces is reused only if all of them are unchanged.
+        """
+        record = None
+        raw = self.store.get(self._key(state, pieces[index]))
+        if raw is not None:
+            record = json.loads(raw)
+            digests = record["digests"]
+            if [piece_digest(piece) for piece in pieces[index: index + len(digests)]] != digests:
+                record = None
+
+        with self._lock:
+            if record is None:
+                self.researched += 1
+            else:
+                self.reused += 1
+        return record
+
+    def put(self, state: str, pieces: Sequence[str], draft: str, context: str = ""):
+        """Saves the draft made of the pieces, the first of them is the one it is looked up by."""
+        record = {"draft": draft, "context": context, "digests": [piece_digest(piece) for piece in pieces]}
+        self.store.put(self._key(state, pieces[0]), json.dumps(record, ensure_ascii=False))
+
+    def __str__(self):
+        total = self.reused + self.researched
+        return f"{self.reused} reused, {self.researched} researched ({self.reused / total if total else 0:.0%} reused)"
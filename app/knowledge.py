@@ -0,0 +1,168 @@
+#
+# Results of the investigations split into fragments, retrieved for the sections of a document within a budget
+#
+
+import gzip
+import json
+import os
+import re
+import threading
+from collections.abc import Mapping
+from typing import Callable, Iterator, Optional
+
+from app.corpus import BM25Index
+
+PARAGRAPH = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+class KnowledgeStore(Mapping[str, str]):
+    """
+    The knowledge base: the result of every investigation keyed by its goal. The results are split into fragments
+    of about `fragment_tokens` tokens along the paragraphs, and a section of a document is given only the fragments
+    most relevant to it which fit the token budget of its prompt.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], fragment_tokens: int = 256):
+        self.count_tokens = count_tokens
+        self.fragment_tokens = fragment_tokens
+        self.results: dict[str, str] = {}
+        # goal and text of every fragment, the fragments of a goal are in the order of the result
+        self.fragments: list[tuple[str, str]] = []
+        self._index: Optional[BM25Index] = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, goal: str) -> str:
+        return self.results[goal]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.results))
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def __setitem__(self, goal: str, result: str):
+        self.add(goal, result)
+
+    def split(self, result: str) -> list[str]:
+        """Packs the paragraphs of the result into fragments, a longer paragraph is split along its sentences."""
+        units: list[tuple[str, int, str]] = []
+        for paragraph in PARAGRAPH.split(result.strip()):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            tokens = self.count_tokens(paragraph)
+            if tokens <= self.fragment_tokens:
+                units.append((paragraph, tokens, "\n\n"))
+                continue
+            sentences = [sentence for sentence in SENTENCE_END.split(paragraph) if sentence]
+            units.extend((sentence, self.count_tokens(sentence), "\n\n" if number == 0 else " ")
+                         for number, sentence in enumerate(sentences))
+
+        fragments = []
+        current, current_tokens = "", 0
+        for text, tokens, separator in units:
+            if current and current_tokens + tokens > self.fragment_tokens:
+                fragments.append(current)
+                current, current_tokens = "", 0
+            current = current + separator + text if current else text
+            current_tokens += tokens
+        if current:
+            fragments.append(current)
+        return fragments
+
+    def add(self, goal: str, result: str):
+        fragments = self.split(result)
+        with self._lock:
+            if goal in self.results:
+                self.fragments = [fragment for fragment in self.fragments if fragment[0] != goal]
+            self.results[goal] = result
+            self.fragments.extend((goal, fragment) for fragment in fragments)
+            self._index = None
+
+    def _lexical_index(self) -> BM25Index:
+        if self._index is None:
+            # the goal is a part of every fragment, it tells what the fragment is about
+            self._index = BM25Index([f"{goal}\n{text}" for goal, text in self.fragments])
+        return self._index
+
+    @staticmethod
+    def header(goal: str) -> str:
+        return f"{goal}:\n"
+
+    def select(self, query: str, budget: int, goals: Optional[list[str]] = None) -> list[str]:
+        """
+        Returns the fragments most relevant to the query which fit `budget` tokens, only of the given goals
+        if they are set. The fragments are grouped by the goal and keep their order in the result.
+        """
+        with self._lock:
+            if not self.fragments:
+                return []
+            scores = self._lexical_index().scores(query)
+            fragments = list(self.fragments)
+        allowed = set(goals) if goals is not None else None
+        candidates = [index for index, (goal, _) in enumerate(fragments) if allowed is None or goal in allowed]
+        # the best matching fragments first, the fragments without a match in the order of the results
+        candidates.sort(key=lambda index: (-scores[index], index))
+
+        selected, used, headed = [], 0, set()
+        for index in candidates:
+            goal, text = fragments[index]
+            tokens = self.count_tokens(text)
+            # the first fragment of a goal is headed by the goal
+            if goal not in headed:
+                tokens += self.count_tokens(self.header(goal))
+            if used + tokens > budget:
+                continue
+            selected.append(index)
+            headed.add(goal)
+            used += tokens
+
+        order = {goal: position for position, goal in enumerate(dict.fromkeys(goal for goal, _ in fragments))}
+        selected.sort(key=lambda index: (order[fragments[index][0]], index))
+        knowledge, previous_goal = [], None
+        for index in selected:
+            goal, text = fragments[index]
+            knowledge.append(self.header(goal) + text if goal != previous_goal else text)
+            previous_goal = goal
+        return knowledge
+
+    def save(self, path: str):
+        """
+        Saves the fragments as gzipped JSON lines: the size of the fragments and the goals first,
+        then the goal number and text of a fragment.
+        """
+        with self._lock:
+            goals = list(self.results)
+            fragments = list(self.fragments)
+        numbers = {goal: number for number, goal in enumerate(goals)}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+            header = {"fragment_tokens": self.fragment_tokens, "goals": goals}
+            file.write(json.dumps(header, ensure_ascii=False) + "\n")
+            for goal, text in fragments:
+                file.write(json.dumps([numbers[goal], text], ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, count_tokens: Callable[[str], int], fragment_tokens: int = 256) -> "KnowledgeStore":
+        """
+        Loads the fragments saved by `save`, the results are joined from their fragments. The results saved
+        with fragments of another size are split again.
+        """
+        store = cls(count_tokens, fragment_tokens)
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            header = json.loads(file.readline())
+            goals = header["goals"]
+            texts: dict[str, list[str]] = {goal: [] for goal in goals}
+            for line in file:
+                number, text = json.loads(line)
+                texts[goals[number]].append(text)
+        for goal, parts in texts.items():
+            if header["fragment_tokens"] == fragment_tokens:
+                store.results[goal] = "\n\n".join(parts)
+                store.fragments.extend((goal, text) for text in parts)
+            else:
+                store.add(goal, "\n\n".join(parts))
+        return store
@@ -1 +1,5 @@
-from .openai_client import ChatModel
\ No newline at end of file
+from .cache import ResponseCache
+from .openai_client import ChatModel
+from .routing import AGENTS, ModelRouter, TieredModel
+from .structured import StructuredOutput, StructuredOutputError, repair_json, structured_output
+from .tokens import count_tokens, get_encoding
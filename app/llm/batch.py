@@ -0,0 +1,186 @@
+#
+# Offline submission of independent prompts in the OpenAI Batch API file format
+#
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+from openai import AzureOpenAI, OpenAI
+
+from .openai_client import ChatModel
+
+ENDPOINT = "/v1/chat/completions"
+# Azure OpenAI expects the endpoint without the version prefix
+AZURE_ENDPOINT = "/chat/completions"
+
+
+class BatchError(Exception):
+    pass
+
+
+class OpenAIBatchBackend:
+    """Uploads the batch input file to the Batch API and downloads the output file when the batch is completed."""
+
+    def __init__(self, is_azure: bool = False):
+        self.client = AzureOpenAI() if is_azure else OpenAI()
+        self.endpoint = AZURE_ENDPOINT if is_azure else ENDPOINT
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=self.endpoint,
+                                           completion_window="24h")
+        return batch.id
+
+    def poll(self, batch_id: str) -> Optional[str]:
+        """Returns the content of the output file when the batch is completed, None while it is in progress."""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise BatchError(f"Batch {batch_id} is {batch.status}")
+        if batch.status != "completed":
+            return None
+        output = self.client.files.content(batch.output_file_id).text if batch.output_file_id else ""
+        if batch.error_file_id:
+            output += "\n" + self.client.files.content(batch.error_file_id).text
+        return output
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Batch API. The requests of the input file are answered by `responder`
+    in a background thread and the output file is written in the Batch API format next to the input file.
+    """
+
+    endpoint = ENDPOINT
+
+    def __init__(self, directory: str, responder: Callable[[dict], str]):
+        self.directory = directory
+        self.responder = responder
+        # the errors of the batches which have failed as a whole, e.g. on a malformed input file
+        self._errors: dict[str, Exception] = {}
+
+    def _output_path(self, batch_id: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}.output.jsonl")
+
+    def _process(self, batch_id: str, input_path: str):
+        try:
+            self._answer(batch_id, input_path)
+        except Exception as e:
+            self._errors[batch_id] = e
+
+    def _answer(self, batch_id: str, input_path: str):
+        tmp_path = f"{self._output_path(batch_id)}.tmp"
+        with open(input_path, "r", encoding="utf-8") as input_file, \
+                open(tmp_path, "w", encoding="utf-8") as output_file:
+            for line in input_file:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                    response = {"status_code": 200,
+                                "body": {"object": "chat.completion",
+                                         "model": request["body"]["model"],
+                                         "choices": [{"index": 0,
+                                                      "message": {"role": "assistant", "content": content},
+                                                      "finish_reason": "stop"}]}}
+                    error = None
+                except Exception as e:
+                    response = None
+                    error = {"code": type(e).__name__, "message": str(e)}
+                output_file.write(json.dumps({"id": f"batch_req_{uuid.uuid4().hex}",
+                                              "custom_id": request["custom_id"],
+                                              "response": response,
+                                              "error": error}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self._output_path(batch_id))
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        threading.Thread(target=self._process, args=(batch_id, input_path), daemon=True).start()
+        return batch_id
+
+    def poll(self, batch_id: str) -> Optional[str]:
+        if batch_id in self._errors:
+            raise BatchError(f"Batch {batch_id} has failed: {self._errors[batch_id]}")
+        try:
+            with open(self._output_path(batch_id), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+class BatchJob:
+    """
+    Collects independent prompts, serializes them into a batch input file, submits it to the backend,
+    waits for the output and returns the responses by their ids. Cached responses are not submitted again,
+    and the received responses are put into the cache of the model.
+    """
+
+    def __init__(self, chat_model: ChatModel, backend, directory: str, poll_interval: float = 30.0,
+                 max_wait: float = 24 * 3600):
+        self.chat_model = chat_model
+        self.backend = backend
+        self.directory = directory
+        self.poll_interval = poll_interval
+        # how long to wait for the batch before giving up on it
+        self.max_wait = max_wait
+        self.requests: dict[str, tuple[str, bool]] = {}
+
+    def add(self, custom_id: str, prompt: str, json_mode: bool = False):
+        self.requests[custom_id] = (prompt, json_mode)
+
+    def run(self) -> dict[str, str]:
+        """
+        Returns the responses by their ids. Requests that failed in the batch are missing from the result.
+        Raises BatchError if the batch fails as a whole or isn't completed within `max_wait` seconds.
+        """
+        responses: dict[str, str] = {}
+        pending: dict[str, tuple[str, bool]] = {}
+        cache = self.chat_model.cache
+        for custom_id, (prompt, json_mode) in self.requests.items():
+            cached = cache.get(self.chat_model.cache_key(prompt, json_mode)) if cache is not None else None
+            if cached is not None:
+                responses[custom_id] = cached
+            else:
+                pending[custom_id] = (prompt, json_mode)
+        if not pending:
+            return responses
+
+        os.makedirs(self.directory, exist_ok=True)
+        input_path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.input.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            for custom_id, (prompt, json_mode) in pending.items():
+                f.write(json.dumps({"custom_id": custom_id,
+                                    "method": "POST",
+                                    "url": self.backend.endpoint,
+                                    "body": self.chat_model.request_body(prompt, json_mode)}, ensure_ascii=False) + "\n")
+
+        batch_id = self.backend.submit(input_path)
+        deadline = time.monotonic() + self.max_wait
+        while (output := self.backend.poll(batch_id)) is None:
+            if time.monotonic() >= deadline:
+                raise BatchError(f"Batch {batch_id} hasn't been completed in {self.max_wait:g} seconds")
+            time.sleep(self.poll_interval)
+
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            custom_id = result.get("custom_id")
+            response = result.get("response") or {}
+            if custom_id not in pending or response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            content = body["choices"][0]["message"]["content"]
+            usage = body.get("usage")
+            if usage:
+                self.chat_model.usage.add(usage["prompt_tokens"], usage["completion_tokens"])
+            if cache is not None:
+                prompt, json_mode = pending[custom_id]
+                cache.put(self.chat_model.cache_key(prompt, json_mode), content)
+            responses[custom_id] = content
+        return responses
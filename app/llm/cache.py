@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of model responses.
+
+    Entries are keyed by the model id, the normalized prompt and the sampling parameters,
+    and are evicted when they get older than `max_age` seconds or when the cache grows over `max_size` bytes
+    (least recently used entries go first).
+    """
+
+    def __init__(self,
+                 directory: str = ".bran_cache/responses",
+                 max_size: int = 512 * 1024 * 1024,
+                 max_age: float = 30 * 24 * 3600,
+                 enabled: bool = True):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size: int | None = None
+
+    @classmethod
+    def from_env(cls, enabled: bool = True) -> "ResponseCache":
+        disabled = os.getenv("CHAT_CACHE_DISABLED", 'False').lower() in ('true', '1', 't')
+        return cls(directory=os.getenv("CHAT_CACHE_DIR", ".bran_cache/responses"),
+                   max_size=int(float(os.getenv("CHAT_CACHE_MAX_SIZE_MB", "512")) * 1024 * 1024),
+                   max_age=float(os.getenv("CHAT_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600,
+                   enabled=enabled and not disabled)
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        return "\n".join(line.rstrip() for line in prompt.strip().splitlines())
+
+    @classmethod
+    def make_key(cls, model_id: str, prompt: str, params: dict) -> str:
+        payload = json.dumps({"model": model_id, "prompt": cls.normalize(prompt), "params": params},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                self.discard(key)
+                response = None
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    response = json.load(f)["response"]
+                # remember the access time for LRU eviction
+                os.utime(path)
+        except (OSError, ValueError, KeyError):
+            response = None
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, key: str, response: str):
+        if not self.enabled or not response:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"response": response}, f, ensure_ascii=False)
+        size = os.path.getsize(tmp_path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_usage()
+            # an overwritten entry no longer takes its size
+            self._size += size - self._file_size(path)
+            os.replace(tmp_path, path)
+            over_limit = self._size > self.max_size
+        if over_limit:
+            self.evict()
+
+    def discard(self, key: str):
+        path = self._path(key)
+        with self._lock:
+            size = self._file_size(path)
+            try:
+                os.remove(path)
+            except OSError:
+                return
+            if self._size is not None:
+                self._size -= size
+
+    @staticmethod
+    def _file_size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _disk_usage(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        now = time.time()
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        # drop expired entries, then the least recently used ones until we are below 90% of the limit
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._size = total
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({ratio:.0%} hit rate)"
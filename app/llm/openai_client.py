@@ -1,13 +1,163 @@
-from openai import AzureOpenAI, OpenAI
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import AsyncIterator, Iterator
+
+import httpx
+from openai import APIConnectionError, AsyncAzureOpenAI, AsyncOpenAI, DefaultAsyncHttpxClient, InternalServerError, \
+    RateLimitError
+
+from app.logger import Logger
+from app.metrics import metrics
+from .cache import ResponseCache
+
+logger = Logger()
+
+_runtime_lock = threading.Lock()
+_loop: asyncio.AbstractEventLoop | None = None
+_http_client: httpx.AsyncClient | None = None
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Returns the process-wide event loop, which runs all requests to the model in a background thread."""
+    global _loop
+    with _runtime_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="chat-model-loop", daemon=True).start()
+        return _loop
+
+
+def _shared_http_client() -> httpx.AsyncClient:
+    """Returns the HTTP transport with the connection pool shared by all chat models."""
+    global _http_client
+    with _runtime_lock:
+        if _http_client is None:
+            max_connections = int(os.getenv("CHAT_MODEL_MAX_CONNECTIONS", "64"))
+            _http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        return _http_client
+
+
+def _retry_after(error: RateLimitError) -> float | None:
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def _cached_tokens(usage) -> int:
+    """Prompt tokens served from the prompt cache of the provider, reported by the API in the usage details."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+class TokenUsage:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # prompt tokens which the provider has served from its prompt cache
+        self.cached_prompt_tokens = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, prompt_tokens: int, completion_tokens: int, seconds: float = 0.0, cached_prompt_tokens: int = 0):
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_prompt_tokens += cached_prompt_tokens
+            self.seconds += seconds
+
+    @property
+    def average_latency(self) -> float | None:
+        """Average time of a call in seconds, including the retries, or None if there have been no calls."""
+        with self._lock:
+            return self.seconds / self.calls if self.calls else None
+
+    def __str__(self):
+        cached_share = self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0
+        return (f"{self.calls} calls, {self.prompt_tokens} prompt and {self.completion_tokens} completion tokens, "
+                f"{self.cached_prompt_tokens} prompt tokens cached by the provider ({cached_share:.0%})")
 
 
 class ChatModel:
-    def __init__(self, model_id: str, is_azure: bool = False):
-        self.client = AzureOpenAI() if is_azure else OpenAI()
+    """
+    Chat completion model.
+
+    All requests are sent by the async client on a shared background event loop, so any number of threads
+    can call `inference` (or `submit`) at once: at most `max_in_flight` requests are sent concurrently,
+    and when the API answers 429 every request waits for the time suggested by the Retry-After header.
+    """
+
+    def __init__(self, model_id: str, is_azure: bool = False, cache: ResponseCache | None = None,
+                 params: dict | None = None, max_in_flight: int | None = None, max_retries: int = 6,
+                 json_mode: bool | None = None):
         self.model_id = model_id
+        self.is_azure = is_azure
+        self.cache = cache
+        # sampling parameters passed to every completion request, e.g. temperature
+        self.params = params or {}
+        self.max_in_flight = max_in_flight or int(os.getenv("CHAT_MODEL_MAX_IN_FLIGHT", "8"))
+        self.max_retries = max_retries
+        # whether the backend supports response_format={"type": "json_object"}
+        self.json_mode = json_mode if json_mode is not None else \
+            os.getenv("CHAT_MODEL_JSON_MODE", 'False').lower() in ('true', '1', 't')
+        self.usage = TokenUsage()
+        self._client: AsyncOpenAI | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._resume_at = 0.0
+
+    @property
+    def tiers(self) -> list["ChatModel"]:
+        """The models which are asked in turn until a response is valid, see `TieredModel`."""
+        return [self]
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return _event_loop()
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            # retries are handled by the model itself to apply the backpressure to all requests
+            client_class = AsyncAzureOpenAI if self.is_azure else AsyncOpenAI
+            self._client = client_class(http_client=_shared_http_client(), max_retries=0)
+        return self._client
 
-    def inference(self, prompt: str) -> str:
-        chat_completion = self.client.chat.completions.create(
+    def request_params(self, json_mode: bool = False) -> dict:
+        if json_mode and self.json_mode:
+            return dict(self.params, response_format={"type": "json_object"})
+        return self.params
+
+    def cache_key(self, prompt: str, json_mode: bool = False) -> str:
+        return ResponseCache.make_key(self.model_id, prompt, self.request_params(json_mode))
+
+    def forget(self, prompt: str, json_mode: bool = False):
+        """Drop a cached response, e.g. when it has been rejected by the validation."""
+        if self.cache is not None:
+            self.cache.discard(self.cache_key(prompt, json_mode))
+
+    async def _wait_for_quota(self):
+        while True:
+            delay = self._resume_at - self.loop.time()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def request_body(self, prompt: str, json_mode: bool = False) -> dict:
+        """Returns the body of the chat completion request, as it is sent to the API or written to a batch file."""
+        return dict(
             messages=[
                 {
                     "role": "user",
@@ -15,6 +165,162 @@ class ChatModel:
                 }
             ],
             model=self.model_id,
+            **self.request_params(json_mode),
         )
-        response = chat_completion.choices[0].message.content
+
+    def _backoff(self, error: Exception, attempt: int) -> float | None:
+        """
+        Returns how long to wait before the next attempt, or None when the request waits for the quota of the model.
+        Raises the error when there are no attempts left.
+        """
+        if attempt > self.max_retries:
+            raise error
+        delay = _retry_after(error) if isinstance(error, RateLimitError) else None
+        if delay is None:
+            delay = min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+        if isinstance(error, RateLimitError):
+            # hold back all requests to this model, not only the rejected one
+            self._resume_at = max(self._resume_at, self.loop.time() + delay)
+            return None
+        return delay
+
+    async def _create(self, body: dict) -> str:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            await self._wait_for_quota()
+            async with self._semaphore:
+                try:
+                    chat_completion = await self.client.chat.completions.create(**body)
+                    usage = chat_completion.usage
+                    cached_tokens = _cached_tokens(usage)
+                    if usage is not None:
+                        self.usage.add(usage.prompt_tokens, usage.completion_tokens, time.perf_counter() - start,
+                                       cached_tokens)
+                        logger.debug(lambda: f"Model `{self.model_id}` call: {usage.prompt_tokens} prompt "
+                                             f"({cached_tokens} cached) and {usage.completion_tokens} "
+                                             f"completion tokens")
+                    metrics.record_request(time.perf_counter() - start,
+                                           prompt_tokens=usage.prompt_tokens if usage is not None else 0,
+                                           completion_tokens=usage.completion_tokens if usage is not None else 0,
+                                           retries=attempt,
+                                           cached_prompt_tokens=cached_tokens)
+                    return chat_completion.choices[0].message.content
+                except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                    attempt += 1
+                    delay = self._backoff(e, attempt)
+                    if delay is None:
+                        continue
+            await asyncio.sleep(delay)
+
+    async def _create_stream(self, body: dict) -> AsyncIterator[str]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            await self._wait_for_quota()
+            async with self._semaphore:
+                # the request is repeated only if it fails before the first piece of the response
+                try:
+                    stream = await self.client.chat.completions.create(**body, stream=True,
+                                                                       stream_options={"include_usage": True})
+                except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                    attempt += 1
+                    delay = self._backoff(e, attempt)
+                    if delay is None:
+                        continue
+                else:
+                    usage = None
+                    async for chunk in stream:
+                        if chunk.usage is not None:
+                            usage = chunk.usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+                    cached_tokens = _cached_tokens(usage)
+                    if usage is not None:
+                        self.usage.add(usage.prompt_tokens, usage.completion_tokens, time.perf_counter() - start,
+                                       cached_tokens)
+                    metrics.record_request(time.perf_counter() - start,
+                                           prompt_tokens=usage.prompt_tokens if usage is not None else 0,
+                                           completion_tokens=usage.completion_tokens if usage is not None else 0,
+                                           retries=attempt,
+                                           cached_prompt_tokens=cached_tokens)
+                    return
+            await asyncio.sleep(delay)
+
+    async def ainference(self, prompt: str, json_mode: bool = False) -> str:
+        """Coroutine version of `inference`. It must be awaited on the model's event loop, see `submit`."""
+        key = self.cache_key(prompt, json_mode) if self.cache is not None else None
+        if key is not None:
+            # the cache is on disk, its files are read and written off the event loop shared by all requests
+            cached = await self.loop.run_in_executor(None, self.cache.get, key)
+            if cached is not None:
+                metrics.record_cache_hit()
+                return cached
+
+        response = await self._create(self.request_body(prompt, json_mode))
+
+        if key is not None:
+            await self.loop.run_in_executor(None, self.cache.put, key, response)
         return response
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        """Async generator version of `stream`. It must be iterated on the model's event loop."""
+        key = self.cache_key(prompt) if self.cache is not None else None
+        if key is not None:
+            cached = await self.loop.run_in_executor(None, self.cache.get, key)
+            if cached is not None:
+                metrics.record_cache_hit()
+                yield cached
+                return
+
+        # a streamed response is not put into the cache, it would have to be kept in memory as a whole
+        async for part in self._create_stream(self.request_body(prompt)):
+            yield part
+
+    async def _labeled_inference(self, prompt: str, json_mode: bool, labels: tuple[str, str]) -> str:
+        # the task on the event loop is attributed to the agent and the plan item of the calling thread
+        metrics.set_labels(labels)
+        return await self.ainference(prompt, json_mode)
+
+    def submit(self, prompt: str, json_mode: bool = False) -> Future:
+        """Schedules the request on the model's event loop and returns a future with the response."""
+        return asyncio.run_coroutine_threadsafe(self._labeled_inference(prompt, json_mode, metrics.labels()),
+                                                self.loop)
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        """Returns the response of the model piece by piece, as soon as the pieces are generated."""
+        parts: queue.Queue = queue.Queue()
+        end = object()
+
+        async def produce(labels: tuple[str, str]):
+            metrics.set_labels(labels)
+            try:
+                async for part in self.astream(prompt):
+                    parts.put(part)
+            except Exception as e:
+                parts.put(e)
+            else:
+                parts.put(end)
+
+        future = asyncio.run_coroutine_threadsafe(produce(metrics.labels()), self.loop)
+        try:
+            while (part := parts.get()) is not end:
+                if isinstance(part, Exception):
+                    raise part
+                yield part
+        finally:
+            future.cancel()
+
+    def inference(self, prompt: str, json_mode: bool = False) -> str:
+        """Returns the response of the model. With `json_mode` the model is asked for a JSON object if supported."""
+        return self.submit(prompt, json_mode).result()
+
+    def inference_many(self, prompts: list[str]) -> list[str]:
+        futures = [self.submit(prompt) for prompt in prompts]
+        return [future.result() for future in futures]
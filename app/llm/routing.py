@@ -0,0 +1,156 @@
+#
+# Chat models of the agents: a model per agent and a fast model asked before the large one
+#
+
+import os
+import threading
+from concurrent.futures import Future
+from typing import Iterator
+
+from app.logger import Logger
+
+from .openai_client import ChatModel
+
+logger = Logger()
+
+AGENTS = ("planner", "list", "action", "research", "summary", "investigation", "structure", "knowledge", "section")
+# the agents whose responses are validated, only they can escalate from a fast model
+VALIDATED_AGENTS = ("list", "action", "research", "investigation", "structure", "knowledge")
+
+
+class TieredModel:
+    """
+    A fast model which is asked first and the large model which a request escalates to when the responses
+    of the fast one are rejected by the validation, see `StructuredOutput.infer`. Requests without validation
+    are answered by the fast model.
+    """
+
+    def __init__(self, agent: str, fast: ChatModel, model: ChatModel, fast_attempts: int = 1):
+        self.agent = agent
+        self.fast = fast
+        self.model = model
+        # how many responses of the fast model may be rejected before the request escalates
+        self.fast_attempts = fast_attempts
+        self.answered = [0, 0]
+        self.fast_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def model_id(self) -> str:
+        return f"{self.fast.model_id}+{self.model.model_id}"
+
+    @property
+    def tiers(self) -> list[ChatModel]:
+        return [self.fast, self.model]
+
+    @property
+    def cache(self):
+        return self.fast.cache
+
+    @property
+    def max_in_flight(self) -> int:
+        return self.fast.max_in_flight
+
+    def forget(self, prompt: str, json_mode: bool = False):
+        for model in self.tiers:
+            model.forget(prompt, json_mode)
+
+    def submit(self, prompt: str, json_mode: bool = False) -> Future:
+        return self.fast.submit(prompt, json_mode)
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        return self.fast.stream(prompt)
+
+    def inference(self, prompt: str, json_mode: bool = False) -> str:
+        return self.fast.inference(prompt, json_mode)
+
+    def inference_many(self, prompts: list[str]) -> list[str]:
+        return self.fast.inference_many(prompts)
+
+    def answer(self, tier: int, seconds: float):
+        """Records that the model of the tier has given a valid response in `seconds`, all attempts included."""
+        with self._lock:
+            self.answered[tier] += 1
+            if tier == 0:
+                self.fast_seconds += seconds
+
+    def escalate(self, tier: int):
+        logger.info(f"The responses of `{self.tiers[tier].model_id}` to the {self.agent} agent have been rejected, "
+                    f"I'm asking `{self.tiers[tier + 1].model_id}`")
+
+    def saved_seconds(self) -> float | None:
+        """
+        Time saved by the answers of the fast model compared to the average latency of the large one,
+        or None if the large model hasn't been called yet.
+        """
+        latency = self.model.usage.average_latency
+        if latency is None:
+            return None
+        with self._lock:
+            return self.answered[0] * latency - self.fast_seconds
+
+    def __str__(self):
+        saved = self.saved_seconds()
+        return (f"{self.answered[0]} answered by `{self.fast.model_id}`, {self.answered[1]} escalated to "
+                f"`{self.model.model_id}`, " + (f"about {saved:.1f} s saved" if saved is not None else
+                                                 "the time saved is unknown"))
+
+
+class ModelRouter:
+    """
+    Chat models of the agents. An agent uses the model CHAT_MODEL_ID_<AGENT> if it is set, otherwise the default
+    model, and with CHAT_MODEL_FAST_ID_<AGENT> it asks the fast model first. Agents of the same model share
+    one ChatModel, every model has its own client, limit of requests in flight and backpressure.
+    """
+
+    def __init__(self, default: ChatModel, fast_attempts: int | None = None):
+        self.default = default
+        self.fast_attempts = fast_attempts or int(os.getenv("CHAT_MODEL_FAST_ATTEMPTS", "1"))
+        self.models: dict[str, ChatModel] = {default.model_id: default}
+        self.routes: dict[str, ChatModel | TieredModel] = {}
+        self._lock = threading.Lock()
+
+    def _model(self, model_id: str) -> ChatModel:
+        if model_id not in self.models:
+            self.models[model_id] = ChatModel(model_id=model_id,
+                                              is_azure=self.default.is_azure,
+                                              cache=self.default.cache,
+                                              params=self.default.params,
+                                              json_mode=self.default.json_mode)
+        return self.models[model_id]
+
+    def route(self, agent: str) -> ChatModel | TieredModel:
+        """Returns the model of the agent, one of `AGENTS`."""
+        with self._lock:
+            if agent not in self.routes:
+                name = agent.upper()
+                model = self._model(os.getenv(f"CHAT_MODEL_ID_{name}") or self.default.model_id)
+                fast_id = os.getenv(f"CHAT_MODEL_FAST_ID_{name}")
+                if fast_id and agent not in VALIDATED_AGENTS:
+                    logger.warning(f"The responses of the {agent} agent are not validated, so they could never "
+                                   f"escalate from a fast model: CHAT_MODEL_FAST_ID_{name} is ignored")
+                    fast_id = None
+                if fast_id and fast_id != model.model_id:
+                    self.routes[agent] = TieredModel(agent, self._model(fast_id), model, self.fast_attempts)
+                else:
+                    self.routes[agent] = model
+            return self.routes[agent]
+
+    def is_routed(self) -> bool:
+        """Whether any agent uses a model other than the default one."""
+        return any(route is not self.default for route in self.routes.values())
+
+    def describe(self) -> str:
+        lines = []
+        for agent, route in self.routes.items():
+            if isinstance(route, TieredModel):
+                lines.append(f"{agent}: `{route.fast.model_id}`, escalating to `{route.model.model_id}`")
+            else:
+                lines.append(f"{agent}: `{route.model_id}`")
+        return "\n".join(lines)
+
+    def usage(self) -> str:
+        return "\n".join(f"`{model_id}`: {model.usage}" for model_id, model in self.models.items())
+
+    def escalations(self) -> str:
+        return "\n".join(f"{agent}: {route}" for agent, route in self.routes.items() if isinstance(route, TieredModel))
@@ -0,0 +1,183 @@
+#
+# Parsing of the structured (JSON) responses of the model
+#
+
+import ast
+import json
+import os
+import re
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+from app.logger import Logger
+from app.metrics import metrics
+from .openai_client import ChatModel
+from .routing import TieredModel
+
+logger = Logger()
+
+T = TypeVar("T")
+
+TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+class StructuredOutputError(Exception):
+    pass
+
+
+def strip_fences(response: str) -> str:
+    response = response.strip().replace("```json", "```")
+
+    if response.startswith("```") and response.endswith("```"):
+        response = response[3:-3].strip()
+
+    return response
+
+
+def _loads(text: str) -> Optional[dict]:
+    try:
+        data = json.loads(text, strict=False)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _literal_eval(text: str) -> Optional[dict]:
+    # single quotes and Python literals
+    try:
+        data = ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _close_truncated(text: str) -> Optional[str]:
+    """
+    Closes the brackets left open by a response that has been cut off. Returns None if the response has been cut off
+    inside a string, the value would be incomplete.
+    """
+    closing = []
+    in_string = False
+    escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            closing.append("}")
+        elif char == "[":
+            closing.append("]")
+        elif char in "}]" and closing:
+            closing.pop()
+
+    if in_string:
+        return None
+    text = text.rstrip().rstrip(",")
+    return text + "".join(reversed(closing))
+
+
+def repair_json(response: str) -> tuple[Optional[dict], bool]:
+    """
+    Parses a JSON object from the response. Returns the object, or None, and whether the response had to be repaired:
+    surrounding prose, single quotes, trailing commas and the brackets of truncated responses are fixed locally.
+    """
+    text = strip_fences(response)
+    data = _loads(text)
+    if data is not None:
+        return data, False
+
+    start = text.find("{")
+    if start < 0:
+        return None, False
+    end = text.rfind("}")
+    candidates = []
+    if end > start:
+        candidates.append(text[start: end + 1])
+    closed = _close_truncated(text[start:])
+    if closed is not None:
+        candidates.append(closed)
+
+    for candidate in candidates:
+        for repair in (_loads, lambda t: _loads(TRAILING_COMMA.sub(r"\1", t)), _literal_eval):
+            data = repair(candidate)
+            if data is not None:
+                return data, True
+    return None, False
+
+
+class StructuredOutput:
+    """
+    Asks the model for a structured response. Broken JSON is repaired locally first, the request is repeated
+    only when the response cannot be parsed or validated, at most `max_attempts` times with an exponential backoff.
+    A tiered model escalates the request to its large model when the responses of the fast one are rejected.
+    """
+
+    def __init__(self, max_attempts: int = 3, backoff: float = 0.5):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.responses = 0
+        self.repaired = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def parse(self, response: str, validate: Callable[[dict], Optional[T]]) -> Optional[T]:
+        """Parses and validates a response, e.g. one received in a batch. Returns None if it is invalid."""
+        data, repaired = repair_json(response)
+        result = validate(data) if data is not None else None
+
+        with self._lock:
+            self.responses += 1
+            if result is not None:
+                self.repaired += repaired
+            else:
+                self.retries += 1
+        return result
+
+    def _infer(self, chat_model: ChatModel, prompt: str, validate: Callable[[dict], Optional[T]],
+               attempts: int) -> Optional[T]:
+        for attempt in range(attempts):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            result = self.parse(chat_model.inference(prompt, json_mode=True), validate)
+            if result is not None:
+                return result
+
+            agent, _ = metrics.labels()
+            logger.warning(f"Invalid response of `{chat_model.model_id}` to the {agent} agent, "
+                           f"attempt {attempt + 1} of {attempts}")
+            metrics.record_rejected()
+            chat_model.forget(prompt, json_mode=True)
+        return None
+
+    def infer(self, chat_model: ChatModel | TieredModel, prompt: str, validate: Callable[[dict], Optional[T]]) -> T:
+        tiers = chat_model.tiers
+        total_attempts = 0
+        for tier, model in enumerate(tiers):
+            last = tier == len(tiers) - 1
+            attempts = self.max_attempts if last else chat_model.fast_attempts
+            total_attempts += attempts
+            start = time.perf_counter()
+            result = self._infer(model, prompt, validate, attempts)
+            if result is not None:
+                if isinstance(chat_model, TieredModel):
+                    chat_model.answer(tier, time.perf_counter() - start)
+                return result
+            if not last:
+                chat_model.escalate(tier)
+
+        raise StructuredOutputError(f"No valid response from the model after {total_attempts} attempts")
+
+    def __str__(self):
+        return (f"{self.responses} responses, {self.repaired} repaired locally instead of asking the model again, "
+                f"{self.retries} rejected")
+
+
+structured_output = StructuredOutput(max_attempts=int(os.getenv("STRUCTURED_OUTPUT_MAX_ATTEMPTS", "3")))
@@ -0,0 +1,16 @@
+import functools
+
+import tiktoken
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_id: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model_id)
+    except KeyError:
+        # unknown and deployment-specific model ids, e.g. on Azure
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_id: str) -> int:
+    return len(get_encoding(model_id).encode(text, disallowed_special=()))
@@ -1,30 +1,75 @@
+import os
+import threading
+from typing import Callable, Union
+
+import fastlogging
 from fastlogging import LogInit
 
+Message = Union[str, Callable[[], str]]
+
+LEVELS = {"DEBUG": fastlogging.DEBUG, "INFO": fastlogging.INFO, "WARNING": fastlogging.WARNING,
+          "ERROR": fastlogging.ERROR}
+
+_init_lock = threading.Lock()
+_shared = None
+
+
+def _shared_logger(filename: str):
+    """
+    Returns the process-wide logger. The messages are queued and written by a background thread in batches,
+    the log file is rotated when it grows over BRAN_LOG_MAX_SIZE_MB.
+    """
+    global _shared
+    with _init_lock:
+        if _shared is None:
+            max_size = int(float(os.getenv("BRAN_LOG_MAX_SIZE_MB", "10")) * 1024 * 1024)
+            _shared = LogInit(level=LEVELS.get(os.getenv("BRAN_LOG_LEVEL", "DEBUG").upper(), fastlogging.DEBUG),
+                              pathName=os.getenv("BRAN_LOG_FILE", filename),
+                              maxSize=max_size,
+                              backupCnt=int(os.getenv("BRAN_LOG_BACKUPS", "3")) if max_size else 0,
+                              console=True,
+                              colors=True,
+                              useThreads=True,
+                              encoding="utf-8")
+        return _shared
+
 
 class Logger:
+    """
+    Facade of the process-wide logger, all instances share it. A message can be given as a function which returns
+    the text, then the text is built only if the level of the message is enabled.
+    """
+
     def __init__(self, filename="bran_agent.log"):
-        self.logger = LogInit(console=True, colors=True, encoding="utf-8")
+        self.filename = filename
+
+    @property
+    def logger(self):
+        # the log file is opened on the first message, not when a module creating a logger is imported
+        return _shared_logger(self.filename)
 
     def read_log_file(self) -> str:
         with open(self.logger.pathName, "r") as file:
             return file.read()
 
-    def info(self, message: str):
-        self.logger.info(message)
-        self.logger.flush()
+    def is_enabled_for(self, level: int) -> bool:
+        return self.logger.level <= level
+
+    def _log(self, level: int, log: Callable[[str], None], message: Message):
+        if self.is_enabled_for(level):
+            log(message() if callable(message) else message)
+
+    def info(self, message: Message):
+        self._log(fastlogging.INFO, self.logger.info, message)
 
-    def error(self, message: str):
-        self.logger.error(message)
-        self.logger.flush()
+    def error(self, message: Message):
+        self._log(fastlogging.ERROR, self.logger.error, message)
 
-    def warning(self, message: str):
-        self.logger.warning(message)
-        self.logger.flush()
+    def warning(self, message: Message):
+        self._log(fastlogging.WARNING, self.logger.warning, message)
 
-    def debug(self, message: str):
-        self.logger.debug(message)
-        self.logger.flush()
+    def debug(self, message: Message):
+        self._log(fastlogging.DEBUG, self.logger.debug, message)
 
-    def exception(self, message: str):
-        self.logger.exception(message)
-        self.logger.flush()
+    def exception(self, message: Message):
+        self._log(fastlogging.EXCEPTION, self.logger.exception, message)
@@ -0,0 +1,254 @@
+#
+# Aggregated latency, token and retry metrics of the agents and the plan items
+#
+
+import contextvars
+import functools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_agent: contextvars.ContextVar[str] = contextvars.ContextVar("agent", default="other")
+_plan_item: contextvars.ContextVar[str] = contextvars.ContextVar("plan_item", default="")
+
+
+def percentile(samples: list[float], quantile: float) -> float:
+    """Nearest-rank percentile of the samples."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(quantile * len(ordered)) - 1)]
+
+
+class Stats:
+    def __init__(self):
+        # executions of the agents, including parsing and retries of invalid responses
+        self.calls = 0
+        self.latencies: list[float] = []
+        # requests to the model, the cached ones are not sent
+        self.requests = 0
+        self.cache_hits = 0
+        self.request_latencies: list[float] = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # prompt tokens served from the prompt cache of the provider
+        self.cached_prompt_tokens = 0
+        # requests repeated after rate limits and connection errors
+        self.retries = 0
+        # responses rejected by the validation
+        self.rejected = 0
+
+    def to_dict(self) -> dict:
+        return {"calls": self.calls,
+                "seconds": sum(self.latencies),
+                "latency": {str(q): percentile(self.latencies, q) for q in QUANTILES},
+                "requests": self.requests,
+                "cache_hits": self.cache_hits,
+                "request_latency": {str(q): percentile(self.request_latencies, q) for q in QUANTILES},
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cached_prompt_tokens": self.cached_prompt_tokens,
+                "retries": self.retries,
+                "rejected": self.rejected}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Collects the metrics per agent and per plan item. The agent and the plan item are taken from the context
+    of the calling thread: they are set by `agent` and `plan_item`, and passed to pooled threads with `bind`.
+    """
+
+    def __init__(self):
+        self.agents: dict[str, Stats] = {}
+        self.plan_items: dict[str, Stats] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def labels() -> tuple[str, str]:
+        """Returns the agent and the plan item of the current context."""
+        return _agent.get(), _plan_item.get()
+
+    @staticmethod
+    def set_labels(labels: tuple[str, str]):
+        """Sets the agent and the plan item of the current context, e.g. of a task on the event loop."""
+        _agent.set(labels[0])
+        _plan_item.set(labels[1])
+
+    def _update(self, update: Callable[[Stats], None]):
+        agent, plan_item = self.labels()
+        with self._lock:
+            update(self.agents.setdefault(agent, Stats()))
+            if plan_item:
+                update(self.plan_items.setdefault(plan_item, Stats()))
+
+    @contextmanager
+    def agent(self, name: str):
+        """Measures the execution of an agent, the model requests inside are attributed to it."""
+        token = _agent.set(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+
+            def update(stats: Stats):
+                stats.calls += 1
+                stats.latencies.append(seconds)
+
+            self._update(update)
+            _agent.reset(token)
+
+    @contextmanager
+    def plan_item(self, name: str):
+        token = _plan_item.set(name)
+        try:
+            yield
+        finally:
+            _plan_item.reset(token)
+
+    @staticmethod
+    def bind(fn: Callable[..., T]) -> Callable[..., T]:
+        """Returns the function which runs in the current context, to keep the labels in pooled threads."""
+        context = contextvars.copy_context()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return context.copy().run(fn, *args, **kwargs)
+
+        return wrapper
+
+    def record_request(self, seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0, retries: int = 0,
+                       cached_prompt_tokens: int = 0):
+        def update(stats: Stats):
+            stats.requests += 1
+            stats.request_latencies.append(seconds)
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cached_prompt_tokens += cached_prompt_tokens
+            stats.retries += retries
+
+        self._update(update)
+
+    def record_cache_hit(self):
+        def update(stats: Stats):
+            stats.requests += 1
+            stats.cache_hits += 1
+
+        self._update(update)
+
+    def record_rejected(self):
+        def update(stats: Stats):
+            stats.rejected += 1
+
+        self._update(update)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"agents": {name: stats.to_dict() for name, stats in self.agents.items()},
+                    "plan_items": {name: stats.to_dict() for name, stats in self.plan_items.items()}}
+
+    def table(self) -> str:
+        """Returns the summary table: where the time and the tokens of the run have gone."""
+        header = (f"{'':<40} {'calls':>6} {'time, s':>8} {'p50, s':>7} {'p95, s':>7} {'p99, s':>7} {'requests':>8} "
+                  f"{'cached':>6} {'retries':>7} {'rejected':>8} {'prompt':>9} {'prefix':>6} {'completion':>10}")
+        lines = []
+        with self._lock:
+            for title, group in (("agent", self.agents), ("plan item", self.plan_items)):
+                if not group:
+                    continue
+                lines.append(title + header[len(title):])
+                for name, stats in sorted(group.items(), key=lambda entry: -sum(entry[1].latencies)):
+                    label = name if len(name) <= 40 else name[:37] + "..."
+                    p50, p95, p99 = (percentile(stats.latencies, q) for q in QUANTILES)
+                    # share of the prompt tokens served from the prompt cache of the provider
+                    prefix = stats.cached_prompt_tokens / stats.prompt_tokens if stats.prompt_tokens else 0
+                    lines.append(f"{label:<40} {stats.calls:>6} {sum(stats.latencies):>8.1f} {p50:>7.2f} "
+                                 f"{p95:>7.2f} {p99:>7.2f} {stats.requests:>8} {stats.cache_hits:>6} "
+                                 f"{stats.retries:>7} {stats.rejected:>8} {stats.prompt_tokens:>9} "
+                                 f"{prefix:>6.0%} {stats.completion_tokens:>10}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for scope, label, group in (("agent", "agent", self.agents), ("plan_item", "item", self.plan_items)):
+                def series(name: str, kind: str, description: str, values: Callable[[Stats], list]):
+                    metric = f"bran_{scope}_{name}"
+                    lines.append(f"# HELP {metric} {description}")
+                    lines.append(f"# TYPE {metric} {kind}")
+                    for key, stats in group.items():
+                        for suffix, extra, value in values(stats):
+                            labels = ",".join([f'{label}="{_escape(key)}"'] + extra)
+                            lines.append(f"{metric}{suffix}{{{labels}}} {value}")
+
+                def summary(samples: list[float]) -> list:
+                    return ([("", [f'quantile="{q}"'], percentile(samples, q)) for q in QUANTILES] +
+                            [("_sum", [], sum(samples)), ("_count", [], len(samples))])
+
+                series("calls_total", "counter", "Executions of the agents",
+                       lambda stats: [("", [], stats.calls)])
+                series("latency_seconds", "summary", "Latency of the agent executions",
+                       lambda stats: summary(stats.latencies))
+                series("requests_total", "counter", "Requests to the model, including the cached ones",
+                       lambda stats: [("", [], stats.requests)])
+                series("cache_hits_total", "counter", "Requests answered from the response cache",
+                       lambda stats: [("", [], stats.cache_hits)])
+                series("request_latency_seconds", "summary", "Latency of the requests sent to the model",
+                       lambda stats: summary(stats.request_latencies))
+                series("tokens_total", "counter", "Tokens of the requests sent to the model",
+                       lambda stats: [("", ['type="prompt"'], stats.prompt_tokens),
+                                      ("", ['type="cached_prompt"'], stats.cached_prompt_tokens),
+                                      ("", ['type="completion"'], stats.completion_tokens)])
+                series("retries_total", "counter", "Requests repeated after rate limits and connection errors",
+                       lambda stats: [("", [], stats.retries)])
+                series("rejected_total", "counter", "Responses rejected by the validation",
+                       lambda stats: [("", [], stats.rejected)])
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write(path: str, content: str):
+        # replaced atomically, so a collector never reads a partial file
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def export(self, json_path: Optional[str] = None, prometheus_path: Optional[str] = None):
+        if json_path:
+            self._write(json_path, json.dumps(self.to_dict(), indent=4, ensure_ascii=False))
+        if prometheus_path:
+            self._write(prometheus_path, self.prometheus())
+
+
+def measured(agent: str):
+    """Decorates the `execute` method of an agent to collect its metrics."""
+
+    def decorator(fn: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _agent.get() == agent:
+                # a retry of the agent is a part of the same execution
+                return fn(*args, **kwargs)
+            with metrics.agent(agent):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+metrics = Metrics()
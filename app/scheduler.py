@@ -0,0 +1,65 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from app.agents.action.action import ActionResponse
+
+WRITING_ACTIONS = ('feature', 'report')
+
+
+@dataclass
+class PlanItem:
+    index: int
+    goal: str
+    action: Optional[ActionResponse] = None
+    depends_on: set[int] = field(default_factory=set)
+
+    @property
+    def label(self) -> str:
+        return f"[step {self.index + 1}]"
+
+
+def link_plan_items(items: list[PlanItem]):
+    """
+    Builds the dependency graph of the plan: investigations do not depend on anything,
+    writing steps need the results of all investigations and wait for the previous writing steps.
+    """
+    investigations = {item.index for item in items if item.action and item.action.action == 'investigate'}
+    previous_writing: set[int] = set()
+    for item in items:
+        if item.action and item.action.action in WRITING_ACTIONS:
+            item.depends_on = investigations | previous_writing
+            previous_writing = {item.index}
+
+
+class PlanScheduler:
+    """Runs plan items on a bounded pool of workers as soon as all their dependencies are done."""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+
+    def run(self, items: list[PlanItem], handler: Callable[[PlanItem], None]):
+        done: set[int] = set()
+        pending = list(items)
+        running: dict[Future, PlanItem] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                ready = [item for item in pending if item.depends_on <= done]
+                for item in ready:
+                    pending.remove(item)
+                    running[pool.submit(handler, item)] = item
+
+                if not running:
+                    raise ValueError(f"Plan items {[item.index for item in pending]} have unsatisfiable dependencies")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item = running.pop(future)
+                    try:
+                        future.result()
+                    except BaseException:
+                        for other in running:
+                            other.cancel()
+                        raise
+                    done.add(item.index)
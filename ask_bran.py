@@ -1,6 +1,6 @@
 import argparse
 
-from app.bran import Bran
+from app.bran import Bran, CONTEXT_MODES, INVESTIGATION_MODES, RETRIEVAL_MODES
 
 
 def ask_multiline(help_text: str = "") -> str:
@@ -19,10 +19,48 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--lang", help="Default language", default="English")
     parser.add_argument("--prompt", help="What to ask Bran for", required=False)
+    parser.add_argument("--no-cache", help="Do not use the cache of model responses", action="store_true")
+    parser.add_argument("--investigation", help="How to read the documentation: piece by piece with a running summary, "
+                                                "all pieces concurrently with merging of the notes, or piece by piece "
+                                                "once for all investigations (fused)",
+                        choices=INVESTIGATION_MODES, default="sequential")
+    parser.add_argument("--context", help="What the sequential research knows about the text before a piece: "
+                                          "a running summary for every goal or a digest shared by all goals",
+                        choices=CONTEXT_MODES, default="running")
+    parser.add_argument("--plan-workers", help="How many plan items can be executed concurrently", type=int, default=4)
+    parser.add_argument("--retrieval", help="Research all pieces of the documentation or only the most relevant ones "
+                                            "by keywords (bm25) or by embeddings (dense)",
+                        choices=RETRIEVAL_MODES, default="none")
+    parser.add_argument("--top-k", help="How many most relevant pieces are researched", type=int, default=20)
+    parser.add_argument("--batch", help="Send independent requests to the model with the Batch API",
+                        action="store_true")
+    parser.add_argument("--stream", help="Write the sections into the document as the model generates them",
+                        action="store_true")
+    parser.add_argument("--run-dir", help="Where the progress of the run is saved, by default a directory in `runs` "
+                                          "named by the hash of the prompt", required=False)
+    parser.add_argument("--resume", help="Resume the run from the saved progress, skipping the completed work",
+                        action="store_true")
+    parser.add_argument("--neighbors", help="How many neighbouring pieces are added on each side of a relevant one",
+                        type=int, default=1)
     args = parser.parse_args()
 
-    prompt = args.prompt if args.prompt else ask_multiline("Please finish your input with an empty line.\n"
-                                                           "What do you want to ask Bran for?")
+    if args.prompt:
+        prompt = args.prompt
+    elif args.resume and args.run_dir:
+        # the prompt is restored from the saved progress
+        prompt = ""
+    else:
+        prompt = ask_multiline("Please finish your input with an empty line.\n"
+                               "What do you want to ask Bran for?")
 
-    bran = Bran(language=args.lang)
-    bran.execute(objective=prompt)
+    bran = Bran(language=args.lang,
+                use_cache=not args.no_cache,
+                investigation_mode=args.investigation,
+                context=args.context,
+                plan_workers=args.plan_workers,
+                retrieval=args.retrieval,
+                top_k=args.top_k,
+                neighbors=args.neighbors,
+                batch=args.batch,
+                stream=args.stream)
+    bran.execute(objective=prompt, run_dir=args.run_dir, resume=args.resume)
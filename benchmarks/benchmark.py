@@ -0,0 +1,211 @@
+#
+# Benchmark of Bran.execute over synthetic documents of increasing size against the mock chat model
+#
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_llm import WORDS, MockLLM
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OBJECTIVE = "Write a report about the architecture of the system described in the documentation"
+
+PHASES = {
+    "planning": ("planner", "list", "action"),
+    "investigation": ("research", "fused research", "summary", "compact", "investigation"),
+    "writing": ("structure", "knowledge", "section"),
+}
+
+
+def synthetic_document(words: int, seed: int = 0) -> str:
+    """Returns a document of about `words` words: headings and paragraphs of random sentences."""
+    rng = random.Random(seed)
+    vocabulary = list(WORDS) + [f"{word}{index}" for word in WORDS for index in range(50)]
+    paragraphs = []
+    written = 0
+    while written < words:
+        if len(paragraphs) % 10 == 0:
+            paragraphs.append(f"## Chapter {len(paragraphs) // 10 + 1}: the {rng.choice(WORDS)} subsystem")
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            length = rng.randint(6, 20)
+            sentence = " ".join(rng.choice(vocabulary) for _ in range(length))
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+            written += length
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs) + "\n"
+
+
+def peak_rss_mb() -> float:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_worker(config: dict):
+    """Runs Bran in this process and prints the measurements, the startup time counts from the process launch."""
+    from app.bran import Bran
+
+    bran = Bran(language="English",
+                use_cache=False,
+                investigation_mode=config["investigation"],
+                context=config["context"],
+                plan_workers=config["plan_workers"],
+                retrieval=config["retrieval"],
+                stream=config["stream"])
+    startup_time = time.time() - float(os.environ["BENCHMARK_STARTED"])
+
+    start = time.perf_counter()
+    bran.execute(objective=OBJECTIVE)
+    wall_time = time.perf_counter() - start
+
+    # the result is written to a file, the console is shared with the background thread of the logger
+    with open(os.environ["BENCHMARK_RESULT"], "w", encoding="utf-8") as f:
+        json.dump({"startup_time": startup_time,
+                   "wall_time": wall_time,
+                   "pieces": len(bran.documentation),
+                   "peak_rss_mb": peak_rss_mb()}, f)
+
+
+def run_once(mock_llm: MockLLM, base_url: str, words: int, args) -> dict:
+    """Runs Bran in a fresh process over a synthetic document, so the startup and peak memory are its own."""
+    with tempfile.TemporaryDirectory(prefix="bran-benchmark-") as work_dir:
+        data_path = os.path.join(work_dir, "documentation.txt")
+        with open(data_path, "w", encoding="utf-8") as f:
+            f.write(synthetic_document(words, seed=args.seed))
+
+        env = dict(os.environ,
+                   OPENAI_BASE_URL=base_url,
+                   OPENAI_API_KEY="benchmark",
+                   CHAT_MODEL_ID=args.model,
+                   CHAT_MODEL_AZURE="False",
+                   CHAT_CACHE_DISABLED="True",
+                   EMBEDDING_MODEL_ID=os.getenv("EMBEDDING_MODEL_ID", "hashing"),
+                   DATA_PATH=data_path,
+                   CORPUS_CACHE_DIR=os.path.join(work_dir, "corpus"),
+                   BRAN_RUNS_DIR=os.path.join(work_dir, "runs"),
+                   PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.getenv("PYTHONPATH")])),
+                   BENCHMARK_RESULT=os.path.join(work_dir, "result.json"),
+                   BENCHMARK_STARTED=str(time.time()))
+        config = {"investigation": args.investigation, "context": args.context, "plan_workers": args.plan_workers,
+                  "retrieval": args.retrieval, "stream": args.stream}
+
+        mock_llm.reset()
+        process = subprocess.run([sys.executable, "-m", "benchmarks.benchmark", "--worker", json.dumps(config)],
+                                 cwd=work_dir, env=env, capture_output=True, text=True)
+        stats = mock_llm.reset()
+        result = None
+        if process.returncode == 0 and os.path.isfile(env["BENCHMARK_RESULT"]):
+            with open(env["BENCHMARK_RESULT"], "r", encoding="utf-8") as f:
+                result = json.load(f)
+
+    if result is None:
+        output = process.stdout + process.stderr
+        raise RuntimeError(f"The benchmark of {words} words has failed:\n" + "\n".join(output.splitlines()[-30:]))
+
+    calls = stats["calls"]
+    result.update(words=words,
+                  calls=calls,
+                  phases={phase: sum(calls.get(agent, 0) for agent in agents) for phase, agents in PHASES.items()},
+                  prompt_tokens=stats["prompt_tokens"],
+                  cached_prompt_tokens=stats["cached_prompt_tokens"],
+                  completion_tokens=stats["completion_tokens"],
+                  rejected=stats["errors"])
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(runs: list[dict], baseline: dict = None):
+    previous = {run["words"]: run for run in (baseline or {}).get("runs", [])}
+
+    def change(run: dict, key: str) -> str:
+        before = previous.get(run["words"], {}).get(key)
+        if not before:
+            return ""
+        return f" ({(run[key] - before) / before:+.0%})"
+
+    print(f"{'words':>8} {'pieces':>7} {'wall, s':>14} {'startup, s':>14} {'calls':>12} "
+          f"{'plan/inv/write':>16} {'tokens':>18} {'cached':>7} {'peak RSS, MB':>16}")
+    for run in runs:
+        run["total_calls"] = sum(run["calls"].values())
+        run["total_tokens"] = run["prompt_tokens"] + run["completion_tokens"]
+        phases = "/".join(str(run["phases"][phase]) for phase in PHASES)
+        # share of the prompt tokens served from the prompt cache of the provider
+        cached = run.get("cached_prompt_tokens", 0) / run["prompt_tokens"] if run["prompt_tokens"] else 0
+        print(f"{run['words']:>8} {run['pieces']:>7} "
+              f"{run['wall_time']:>8.2f}{change(run, 'wall_time'):>6} "
+              f"{run['startup_time']:>8.2f}{change(run, 'startup_time'):>6} "
+              f"{run['total_calls']:>6}{change(run, 'total_calls'):>6} "
+              f"{phases:>16} "
+              f"{run['total_tokens']:>12}{change(run, 'total_tokens'):>6} "
+              f"{cached:>7.0%} "
+              f"{run['peak_rss_mb']:>10.1f}{change(run, 'peak_rss_mb'):>6}")
+    if baseline:
+        print(f"Changes are relative to commit {baseline.get('commit', 'unknown')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure Bran against the local mock chat model")
+    parser.add_argument("--sizes", help="Sizes of the synthetic documents in words", type=int, nargs="+",
+                        default=[5000, 20000, 80000])
+    parser.add_argument("--investigation", choices=("sequential", "map-reduce", "fused"), default="map-reduce")
+    parser.add_argument("--context", choices=("running", "digest"), default="running")
+    parser.add_argument("--stream", help="Stream the sections into the documents", action="store_true")
+    parser.add_argument("--retrieval", choices=("none", "bm25", "dense"), default="none")
+    parser.add_argument("--plan-workers", type=int, default=4)
+    parser.add_argument("--investigations", help="How many investigations are in the plan", type=int, default=3)
+    parser.add_argument("--model", help="Model id, it selects the tokenizer", default="gpt-3.5-turbo")
+    parser.add_argument("--latency", help="Seconds before every reply", type=float, default=0.2)
+    parser.add_argument("--jitter", help="Random deviation of the latency in seconds", type=float, default=0.05)
+    parser.add_argument("--error-rate", help="Share of the requests rejected with 429", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", help="Speed of the completion, 0 for instant", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Show the changes relative to the results saved by a previous run")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(json.loads(args.worker))
+        sys.exit(0)
+
+    mock_llm = MockLLM(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                       tokens_per_second=args.tokens_per_second, investigations=args.investigations, seed=args.seed)
+    base_url = mock_llm.start()
+    try:
+        runs = []
+        for size in args.sizes:
+            print(f"Running the benchmark over {size} words...", flush=True)
+            runs.append(run_once(mock_llm, base_url, size, args))
+    finally:
+        mock_llm.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(runs, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"commit": git_commit(),
+                       "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "config": {key: value for key, value in vars(args).items()
+                                  if key not in ("output", "compare", "worker")},
+                       "runs": runs}, f, indent=4)
+        print(f"The results are saved to {args.output}")
@@ -0,0 +1,309 @@
+#
+# Local OpenAI-compatible chat completion server with canned replies of the agents, for benchmarks
+#
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+
+# the agent is recognized by a line of its prompt template, the first match wins
+AGENT_MARKERS = (
+    ("action", "Current plan item:"),
+    ("fused research", "keep notes to achieve several goals at once"),
+    ("research", "Current piece of text:"),
+    ("investigation", "Here are your notes:"),
+    ("compact", "The summary has become too long."),
+    ("summary", "Progressively summarize the lines of text"),
+    ("knowledge", '"need_more_data"'),
+    ("structure", "top-level document structure"),
+    ("section", "Your task is generate content of document section"),
+    ("list", '"list": ['),
+    ("planner", "create a step-by-step plan"),
+)
+
+CURRENT_ITEM = re.compile(r"Current plan item: (.*)")
+FUSED_DRAFT_KEY = re.compile(r'^\s*"(\d+)": "Your notes', re.MULTILINE)
+
+# the prompt cache of the provider: prefixes of at least 1024 tokens are cached in increments of 128 tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_INCREMENT_TOKENS = 128
+
+WORDS = ("service", "request", "storage", "account", "token", "session", "module", "queue", "record", "index",
+         "client", "server", "schema", "config", "report", "policy", "limit", "event", "handler", "cache")
+
+
+def count_tokens(text: str) -> int:
+    """Rough number of tokens, good enough for the throughput of a mock."""
+    return max(1, len(text) // 4)
+
+
+class MockLLM:
+    """
+    Chat completion endpoint which answers every agent of Bran with a valid canned reply. Replies are delayed
+    by `latency` seconds plus a random `jitter` and the time to generate the completion at `tokens_per_second`,
+    and a share of the requests given by `error_rate` is rejected with 429 Too Many Requests.
+    Like the API, it reports the prompt tokens of a prefix which has been sent before as cached.
+    The random choices are seeded, so a run over the same document sends the same replies.
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 tokens_per_second: float = 0.0,
+                 investigations: int = 3,
+                 reply_words: int = 40,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens_per_second = tokens_per_second
+        self.investigations = investigations
+        self.reply_words = reply_words
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._prefixes: set[bytes] = set()
+        self.reset()
+
+    def reset(self) -> dict:
+        """Clears the statistics and returns the previous ones."""
+        with self._lock:
+            stats = getattr(self, "stats", {})
+            self.stats = {"calls": {}, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0,
+                          "errors": 0}
+            self._prefixes.clear()
+        return stats
+
+    def cached_tokens(self, prompt: str) -> int:
+        """Returns how many tokens of the prompt are a cached prefix and caches the prefixes of the prompt."""
+        step = PROMPT_CACHE_INCREMENT_TOKENS * 4
+        digest = hashlib.sha1()
+        cached = 0
+        matching = True
+        with self._lock:
+            for end in range(step, len(prompt) + 1, step):
+                digest.update(prompt[end - step: end].encode("utf-8"))
+                key = digest.copy().digest()
+                if matching and key in self._prefixes:
+                    cached = end
+                else:
+                    matching = False
+                    self._prefixes.add(key)
+        tokens = count_tokens(prompt[:cached]) if cached else 0
+        return tokens if tokens >= PROMPT_CACHE_MIN_TOKENS else 0
+
+    def _words(self, count: int) -> str:
+        with self._lock:
+            return " ".join(self._random.choice(WORDS) for _ in range(count))
+
+    def _plan_items(self) -> list[str]:
+        items = [f"Investigate the {word} subsystem" for word in WORDS[:self.investigations]]
+        return items + ["Write a report with the results"]
+
+    def reply(self, prompt: str) -> tuple[str, str]:
+        """Returns the agent which has sent the prompt and the reply."""
+        agent = next((agent for agent, marker in AGENT_MARKERS if marker in prompt), "unknown")
+        if agent == "planner":
+            steps = "\n".join(f"- [ ] Step {index + 1}: {item}" for index, item in enumerate(self._plan_items()))
+            text = (f"Project Name: Benchmark\nYour Reply to the Human Prompter: Sure\nCurrent Focus: benchmark\n"
+                    f"Plan:\n{steps}\nSummary: {self._words(self.reply_words // 4)}")
+        elif agent == "list":
+            text = json.dumps({"list": self._plan_items()})
+        elif agent == "action":
+            match = CURRENT_ITEM.search(prompt)
+            item = match.group(1) if match else ""
+            text = json.dumps({"response": "Sure", "action": "report" if item.startswith("Write") else "investigate"})
+        elif agent == "fused research":
+            drafts = {key: self._words(self.reply_words) for key in FUSED_DRAFT_KEY.findall(prompt)}
+            text = json.dumps({"drafts": drafts, "action": "next"})
+        elif agent == "research":
+            text = json.dumps({"draft": self._words(self.reply_words), "action": "next"})
+        elif agent == "investigation":
+            text = json.dumps({"result": self._words(self.reply_words * 2)})
+        elif agent in ("summary", "compact"):
+            text = self._words(self.reply_words)
+        elif agent == "knowledge":
+            text = json.dumps({"need_more_data": self._plan_items()[:self.investigations]})
+        elif agent == "structure":
+            text = json.dumps({"title": "Benchmark report", "sections": ["Overview", "Details", "Conclusion"]})
+        elif agent == "section":
+            text = f"# Section\n\n{self._words(self.reply_words * 5)}"
+        else:
+            text = self._words(self.reply_words)
+        return agent, text
+
+    def _delay(self, completion_tokens: int) -> float:
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        delay = self.latency + jitter
+        if self.tokens_per_second:
+            delay += completion_tokens / self.tokens_per_second
+        return max(0.0, delay)
+
+    def _is_rejected(self) -> bool:
+        with self._lock:
+            rejected = self.error_rate > 0 and self._random.random() < self.error_rate
+            if rejected:
+                self.stats["errors"] += 1
+        return rejected
+
+    def _record(self, agent: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int):
+        with self._lock:
+            calls = self.stats["calls"]
+            calls[agent] = calls.get(agent, 0) + 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_prompt_tokens"] += cached_tokens
+            self.stats["completion_tokens"] += completion_tokens
+
+    @staticmethod
+    def _usage(prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> dict:
+        return {"prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+    def complete(self, body: dict) -> Optional[dict]:
+        """Returns the chat completion for the request body, or None if the request is rejected."""
+        if self._is_rejected():
+            return None
+        prompt = body["messages"][-1]["content"]
+        agent, text = self.reply(prompt)
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(text)
+        cached_tokens = self.cached_tokens(prompt)
+        time.sleep(self._delay(completion_tokens))
+
+        self._record(agent, prompt_tokens, cached_tokens, completion_tokens)
+        return {"id": f"chatcmpl-mock-{time.monotonic_ns()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                "usage": self._usage(prompt_tokens, cached_tokens, completion_tokens)}
+
+    def complete_stream(self, body: dict) -> Optional[Iterator[dict]]:
+        """Returns the chunks of the streamed chat completion, or None if the request is rejected."""
+        if self._is_rejected():
+            return None
+        prompt = body["messages"][-1]["content"]
+        agent, text = self.reply(prompt)
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(text)
+        cached_tokens = self.cached_tokens(prompt)
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunks() -> Iterator[dict]:
+            completion_id = f"chatcmpl-mock-{time.monotonic_ns()}"
+
+            def chunk(delta: dict, finish_reason: Optional[str] = None, usage: Optional[dict] = None) -> dict:
+                choices = [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else []
+                return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": body.get("model", "mock"), "choices": choices, "usage": usage}
+
+            # the latency is spent before the first piece, the completion time is spread over the pieces
+            time.sleep(self._delay(0))
+            pieces = re.findall(r"\S*\s*", text)
+            for piece in pieces:
+                if self.tokens_per_second:
+                    time.sleep(count_tokens(piece) / self.tokens_per_second)
+                yield chunk({"role": "assistant", "content": piece})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk({}, usage=self._usage(prompt_tokens, cached_tokens, completion_tokens))
+            self._record(agent, prompt_tokens, cached_tokens, completion_tokens)
+
+        return chunks()
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Starts the server in a background thread and returns its base URL. Port 0 picks a free port."""
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so the connection pool of the client is exercised as with the real API
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, payload: dict, headers: Optional[dict] = None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _reject(self):
+                self._send(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                           headers={"retry-after-ms": "50"})
+
+            def _stream(self, chunks: Optional[Iterator[dict]]):
+                if chunks is None:
+                    self._reject()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in chunks:
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self._write_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                if body.get("stream"):
+                    self._stream(mock.complete_stream(body))
+                    return
+                completion = mock.complete(body)
+                if completion is None:
+                    self._reject()
+                else:
+                    self._send(200, completion)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="mock-llm", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}/v1"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve canned replies of the agents at an OpenAI-compatible endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", help="Seconds before every reply", type=float, default=0.2)
+    parser.add_argument("--jitter", help="Random deviation of the latency in seconds", type=float, default=0.05)
+    parser.add_argument("--error-rate", help="Share of the requests rejected with 429", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", help="Speed of the completion, 0 for instant", type=float, default=0.0)
+    parser.add_argument("--investigations", help="How many investigations are in the plan", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mock_llm = MockLLM(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                       tokens_per_second=args.tokens_per_second, investigations=args.investigations, seed=args.seed)
+    print(f"Serving the mock chat model at {mock_llm.start(args.host, args.port)}, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock_llm.stop()
@@ -0,0 +1,52 @@
+#
+# Local repair of the JSON responses of the model
+#
+
+from app.agents.action.action import Action
+from app.agents.investigate import FusedResearch, Research
+from app.llm.structured import repair_json
+
+
+def test_valid_response_is_not_repaired():
+    assert repair_json('{"draft": "a", "action": "next"}') == ({"draft": "a", "action": "next"}, False)
+
+
+def test_fenced_response_with_prose():
+    response = 'Here you go:\n```json\n{"draft": "a", "action": "next"}\n```'
+    assert repair_json(response) == ({"draft": "a", "action": "next"}, True)
+
+
+def test_trailing_comma_and_single_quotes():
+    assert repair_json('{"draft": "a", "action": "next",}') == ({"draft": "a", "action": "next"}, True)
+    assert repair_json("{'draft': 'a', 'action': 'next'}") == ({"draft": "a", "action": "next"}, True)
+
+
+def test_truncated_brackets_are_closed():
+    assert repair_json('{"draft": "a", "action": "next"') == ({"draft": "a", "action": "next"}, True)
+    assert repair_json('{"sections": ["a", "b"') == ({"sections": ["a", "b"]}, True)
+
+
+def test_response_truncated_inside_a_string_is_rejected():
+    assert repair_json('{"draft": "a", "action": "ne') == (None, False)
+    assert repair_json('{"draft": "notes cut o') == (None, False)
+    assert repair_json('{"drafts": {"1": "a", "2": "b') == (None, False)
+
+
+def test_escaped_quote_does_not_end_the_string():
+    assert repair_json('{"draft": "say \\"hi') == (None, False)
+    assert repair_json('{"draft": "say \\"hi\\""') == ({"draft": 'say "hi"'}, True)
+
+
+def test_action_outside_the_allowed_set_is_rejected():
+    action = Action(chat_model=None)
+    assert action.validate_response({"response": "ok", "action": "inv"}) is None
+    assert action.validate_response({"response": "ok"}) is None
+    assert action.validate_response({"response": "ok", "action": "investigate"}).action == "investigate"
+
+
+def test_research_action_outside_the_allowed_set_is_rejected():
+    research = Research(chat_model=None, language="English")
+    assert research.validate_response({"draft": "a", "action": "ne"}) is None
+    assert research.validate_response({"draft": "a", "action": "more"}).action == "more"
+    assert FusedResearch.validate_response({"drafts": {"1": "a"}, "action": "mo"}, 2) is None
+    assert FusedResearch.validate_response({"drafts": {"1": "a"}, "action": "next"}, 2).drafts == ["a", ""]